@@ -1,9 +1,37 @@
 import os
 import re
+import copy
+import glob
+import struct
 import json
+import math
+import queue
+import atexit
+import asyncio
+import hashlib
+import bisect
+import resource
+import threading
+import time
+import multiprocessing
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Future, wait
 import torch
+import torch.nn.functional as F
+from accelerate import init_empty_weights
 from peft import PeftModel
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from safetensors.torch import load_file, save_model
+from transformers import (
+    AutoConfig,
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    BatchEncoding,
+    DynamicCache,
+    LogitsProcessor,
+    LogitsProcessorList,
+    TextIteratorStreamer,
+)
 
 # --- NPU Environment Detection ---
 IS_NPU = False
@@ -15,54 +43,2268 @@ except ImportError:
     IS_NPU = False
 
 
+# --- Inference Options ---
+USE_CONSTRAINED_DECODING = False
+STOP_STRINGS = ["</tool>"]
+MIN_NEW_TOKENS = 128  # floor of the per-request budget, leaves room for clarification questions
+USE_SPECULATIVE_DECODING = False
+DRAFT_MODEL_PATH = None  # optional small model sharing the tokenizer, e.g. "models/Qwen3-0.6B"
+NUM_DRAFT_TOKENS = 8
+MAX_NGRAM_SIZE = 3
+USE_TOOL_RETRIEVAL = False
+TOOL_RETRIEVAL_TOP_K = 20
+USE_RADIX_CACHE = False
+RADIX_CACHE_MAX_MB = 1536  # KV budget for the radix cache, the whole device is capped at 5 GB
+RESPONSE_CACHE_SIZE = 0     # max cached responses, 0 disables the cache
+RESPONSE_CACHE_PATH = None  # e.g. "./cache/responses.json" to keep the cache across restarts
+WAKE_WORDS = ("小艺小艺",)
+LORA_ADAPTERS = None  # e.g. {"phone": "./lora_weights/", "car": "./lora_weights_car/"}: served unmerged, picked per request
+FAST_PATH_INDEX_PATH = None  # e.g. "./fast_path.json", built by utils/build_fast_path.py
+FAST_PATH_THRESHOLD = 1.0  # 1.0 = exact utterance match only; lower also accepts near matches
+HISTORY_MAX_TOKENS = None  # e.g. 512: fold older executed turns (see compact_history); also read by train_utils.py
+HISTORY_KEEP_ROUNDS = 1
+MEMORY_BUDGET_MB = None  # e.g. 5120 on the NPU; None disables planning and enforcement
+MEMORY_RESERVE_MB = 512  # activations / allocator slack kept out of the KV plan
+RSS_SAMPLE_INTERVAL_S = 0.005  # CPU: VmRSS sampling period for the per-request memory peak
+QUANTIZATION = None  # None (bf16), "int8" or "int4"
+MERGED_MODEL_PATH = "./merged_model/"  # written by utils/export_merged_model.py, skips the LoRA merge on start
+WARMUP_RUNS = 2
+QUANTIZED_MODEL_PATH = "./quantized_model/"  # one sub-directory per mode, written on first quantized start
+
+
+# --- Pre-Merged Model Artifact ---
+MERGE_CONFIG_NAME = "merge.json"
+
+
+def _adapter_fingerprint(lora_weights_path):
+    # size + mtime of the adapter files; a retrained adapter invalidates the merged artifact
+    fingerprint = {}
+    for name in sorted(os.listdir(lora_weights_path)):
+        if name.startswith("adapter_"):
+            stat = os.stat(os.path.join(lora_weights_path, name))
+            fingerprint[name] = [stat.st_size, int(stat.st_mtime)]
+    return fingerprint
+
+
+def merged_model_is_current(merged_model_path, base_model_path, lora_weights_path):
+    config_path = os.path.join(merged_model_path, MERGE_CONFIG_NAME)
+    if not os.path.exists(config_path) or not lora_weights_path or not os.path.exists(lora_weights_path):
+        return False
+    with open(config_path, "r", encoding="utf-8") as f:
+        merge_config = json.load(f)
+    return (
+        merge_config.get("base_model_path") == base_model_path
+        and merge_config.get("adapter_fingerprint") == _adapter_fingerprint(lora_weights_path)
+    )
+
+
+_SAFETENSORS_DTYPES = {
+    "BF16": torch.bfloat16, "F16": torch.float16, "F32": torch.float32,
+    "I64": torch.int64, "I32": torch.int32, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+
+def mmap_safetensors(file_path):
+    """
+    Zero-copy state dict over a safetensors file. The file is mapped copy-on-write and every
+    tensor is a view into the mapping, so processes loading the same file share its pages
+    through the page cache instead of each holding a private copy.
+    """
+    with open(file_path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len))
+    storage = torch.UntypedStorage.from_file(file_path, shared=False, nbytes=os.path.getsize(file_path))
+    data_start = 8 + header_len
+    state_dict = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        begin, _ = info["data_offsets"]
+        element_size = torch.empty((), dtype=dtype).element_size()
+        offset = data_start + begin
+        if offset % element_size:
+            raise ValueError(f"{name} in {file_path} is not aligned to its dtype, cannot map it in place.")
+        tensor = torch.empty(0, dtype=dtype)
+        tensor.set_(storage, offset // element_size, info["shape"])
+        state_dict[name] = tensor
+    return state_dict
+
+
+def load_mmap_model(model_dir):
+    # CPU only: parameters stay views into the mapped safetensors files
+    config = AutoConfig.from_pretrained(model_dir, trust_remote_code=True)
+    with init_empty_weights(include_buffers=False):
+        model = AutoModelForCausalLM.from_config(config, trust_remote_code=True, torch_dtype=torch.bfloat16)
+    state_dict = {}
+    for file_path in sorted(glob.glob(os.path.join(model_dir, "*.safetensors"))):
+        state_dict.update(mmap_safetensors(file_path))
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+    missing = [name for name, param in model.named_parameters() if param.device.type == "meta"]
+    if missing:
+        raise ValueError(f"{model_dir} is missing weights for {missing[:5]}")
+    return model
+
+
+# --- Weight-Only Quantization ---
+QUANT_CONFIG_NAME = "quantization.json"
+QUANT_WEIGHTS_NAME = "model.safetensors"
+QUANT_GROUP_SIZE = 128
+QUANT_BITS = {"int8": 8, "int4": 4}
+QUANT_TILE_ELEMENTS = 1 << 21  # weights dequantized per matmul tile (4MB in bf16)
+
+
+class QuantLinear(torch.nn.Module):
+    """
+    Weight-only quantized replacement for nn.Linear. Weights are stored as symmetric
+    int8, or int4 packed two per byte, with one scale per group of `group_size` input
+    features. forward() dequantizes QUANT_TILE_ELEMENTS weights (a block of output rows)
+    at a time, so at most one tile exists in the activation dtype, never the whole layer.
+    """
+
+    def __init__(self, in_features, out_features, bits=8, group_size=128, bias=False, dtype=torch.bfloat16, device=None):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        packed_in = in_features // 2 if bits == 4 else in_features
+        qdtype = torch.uint8 if bits == 4 else torch.int8
+        self.register_buffer("qweight", torch.zeros((out_features, packed_in), dtype=qdtype, device=device))
+        self.register_buffer(
+            "scales", torch.zeros((out_features, in_features // group_size), dtype=dtype, device=device)
+        )
+        self.bias = torch.nn.Parameter(torch.zeros(out_features, dtype=dtype, device=device)) if bias else None
+
+    @classmethod
+    def from_linear(cls, linear, bits=8, group_size=128):
+        out_features, in_features = linear.weight.shape
+        layer = cls(
+            in_features, out_features, bits, group_size, linear.bias is not None,
+            dtype=linear.weight.dtype, device=linear.weight.device,
+        )
+        qmax = 2 ** (bits - 1) - 1
+        weight = linear.weight.detach().float().reshape(out_features, -1, group_size)
+        scales = (weight.abs().amax(dim=-1, keepdim=True) / qmax).clamp(min=1e-8)
+        q = torch.round(weight / scales).clamp(-qmax - 1, qmax).reshape(out_features, in_features).to(torch.int8)
+        if bits == 4:
+            q = (q + 8).to(torch.uint8)
+            q = q[:, 0::2] | (q[:, 1::2] << 4)
+        layer.qweight.copy_(q)
+        layer.scales.copy_(scales.squeeze(-1).to(layer.scales.dtype))
+        if linear.bias is not None:
+            layer.bias.data.copy_(linear.bias.data)
+        return layer
+
+    def dequantize(self, start=0, end=None):
+        """Weight rows [start, end) in the scales' dtype."""
+        end = self.out_features if end is None else end
+        qweight = self.qweight[start:end]
+        if self.bits == 4:
+            low = (qweight & 0x0F).to(torch.int8) - 8
+            high = (qweight >> 4).to(torch.int8) - 8
+            q = torch.stack([low, high], dim=-1).reshape(end - start, self.in_features)
+        else:
+            q = qweight
+        weight = q.reshape(end - start, -1, self.group_size).to(self.scales.dtype)
+        return (weight * self.scales[start:end].unsqueeze(-1)).reshape(end - start, self.in_features)
+
+    def forward(self, x):
+        rows = max(QUANT_TILE_ELEMENTS // self.in_features, 1)
+        if rows >= self.out_features:
+            return F.linear(x, self.dequantize().to(x.dtype), self.bias)
+        output = x.new_empty(*x.shape[:-1], self.out_features)
+        for start in range(0, self.out_features, rows):
+            end = min(start + rows, self.out_features)
+            bias = self.bias[start:end] if self.bias is not None else None
+            output[..., start:end] = F.linear(x, self.dequantize(start, end).to(x.dtype), bias)
+        return output
+
+
+def quantize_model(model, bits=8, group_size=128, skip_modules=("lm_head",), empty=False):
+    """Swaps every nn.Linear (except skip_modules) for a QuantLinear; empty=True only builds the shells."""
+    replaced = 0
+    for name, module in list(model.named_modules()):
+        if not isinstance(module, torch.nn.Linear) or name.split(".")[-1] in skip_modules:
+            continue
+        if module.in_features % group_size:
+            continue
+        if empty:
+            quantized = QuantLinear(
+                module.in_features, module.out_features, bits, group_size, module.bias is not None,
+                dtype=module.weight.dtype, device=module.weight.device,
+            )
+        else:
+            quantized = QuantLinear.from_linear(module, bits, group_size)
+        parent_name, _, child_name = name.rpartition(".")
+        setattr(model.get_submodule(parent_name) if parent_name else model, child_name, quantized)
+        replaced += 1
+    return replaced
+
+
+def _quantization_source(base_model_path, lora_weights_path, bits, group_size):
+    # everything the quantized weights depend on; the adapter only counts if it would have been merged
+    merged = bool(lora_weights_path) and os.path.exists(lora_weights_path)
+    return {
+        "bits": bits,
+        "group_size": group_size,
+        "base_model_path": base_model_path,
+        "lora_weights_path": lora_weights_path if merged else None,
+        "adapter_fingerprint": _adapter_fingerprint(lora_weights_path) if merged else None,
+    }
+
+
+def save_quantized_model(model, output_dir, bits, group_size, base_model_path, lora_weights_path=None):
+    os.makedirs(output_dir, exist_ok=True)
+    model.config.save_pretrained(output_dir)
+    save_model(model, os.path.join(output_dir, QUANT_WEIGHTS_NAME))
+    with open(os.path.join(output_dir, QUANT_CONFIG_NAME), "w", encoding="utf-8") as f:
+        json.dump(_quantization_source(base_model_path, lora_weights_path, bits, group_size), f, indent=2)
+    print(f"Quantized int{bits} model saved to {output_dir}")
+
+
+def quantized_model_is_current(quantized_model_path, base_model_path, lora_weights_path, quantization,
+                               group_size=QUANT_GROUP_SIZE):
+    config_path = os.path.join(quantized_model_path, QUANT_CONFIG_NAME) if quantized_model_path else None
+    if config_path is None or not os.path.exists(config_path) or quantization not in QUANT_BITS:
+        return False
+    with open(config_path, "r", encoding="utf-8") as f:
+        quant_config = json.load(f)
+    return quant_config == _quantization_source(base_model_path, lora_weights_path, QUANT_BITS[quantization], group_size)
+
+
+def load_quantized_model(model_dir, device):
+    with open(os.path.join(model_dir, QUANT_CONFIG_NAME), "r", encoding="utf-8") as f:
+        quant_config = json.load(f)
+    config = AutoConfig.from_pretrained(model_dir, trust_remote_code=True)
+    # build on the meta device: the bf16 weights are never allocated, only the int tensors are loaded
+    with init_empty_weights(include_buffers=False):
+        model = AutoModelForCausalLM.from_config(config, trust_remote_code=True, torch_dtype=torch.bfloat16)
+    quantize_model(model, quant_config["bits"], quant_config["group_size"], empty=True)
+    state_dict = load_file(os.path.join(model_dir, QUANT_WEIGHTS_NAME), device=str(device))
+    # strict=False only because tied weights (lm_head) are stored once; anything else must match
+    result = model.load_state_dict(state_dict, strict=False, assign=True)
+    if result.unexpected_keys:
+        raise ValueError(f"{model_dir} has unexpected weights {result.unexpected_keys[:5]}")
+    model.tie_weights()
+    missing = [
+        name for name, tensor in list(model.named_parameters()) + list(model.named_buffers())
+        if tensor.device.type == "meta"
+    ]
+    if missing:
+        raise ValueError(f"{model_dir} is missing weights for {missing[:5]}")
+    return model.to(device), quant_config
+
+
+# --- Latency Instrumentation ---
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+
+def _proc_status_mb(field):
+    # VmRSS / VmHWM from /proc/self/status, in MB
+    with open("/proc/self/status", "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    raise OSError(f"{field} not found in /proc/self/status")
+
+
+def _device_live_memory_mb(device):
+    backend = getattr(torch, device.type, None)
+    if device.type != "cpu" and hasattr(backend, "memory_allocated"):
+        return backend.memory_allocated(device) / (1024 * 1024)
+    try:
+        return _proc_status_mb("VmRSS")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class _PeakMemoryMonitor:
+    """
+    Peak memory while one request runs. Accelerators reset and read the allocator's peak
+    counter. On CPU VmHWM is the process-lifetime high-water mark (model load and LoRA merge
+    included), so a thread samples VmRSS every `interval_s` until stop() instead.
+    """
+
+    def __init__(self, device, interval_s=RSS_SAMPLE_INTERVAL_S):
+        self.device = device
+        self.peak_mb = None
+        self._thread = None
+        backend = getattr(torch, device.type, None)
+        if device.type != "cpu" and hasattr(backend, "max_memory_allocated"):
+            backend.reset_peak_memory_stats(device)
+            return
+        self._sampled_mb = _device_live_memory_mb(device)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, args=(interval_s,), daemon=True)
+        self._thread.start()
+
+    def _sample(self, interval_s):
+        while not self._stopped.wait(interval_s):
+            self._sampled_mb = max(self._sampled_mb, _device_live_memory_mb(self.device))
+
+    def stop(self):
+        """Peak in MB since construction; later calls return the same value."""
+        if self.peak_mb is not None:
+            return self.peak_mb
+        if self._thread is None:
+            self.peak_mb = getattr(torch, self.device.type).max_memory_allocated(self.device) / (1024 * 1024)
+        else:
+            self._stopped.set()
+            self._thread.join()
+            self.peak_mb = max(self._sampled_mb, _device_live_memory_mb(self.device))
+        return self.peak_mb
+
+
+class _NullTimer:
+    """Stand-in used when instrumentation is off; every call is a no-op."""
+
+    enabled = False
+
+    def lap(self, stage):
+        pass
+
+    def forward_hook(self, module, args, output):
+        pass
+
+    def set(self, **metrics):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+class StageTimer:
+    """
+    Wall time per stage of one request. lap(stage) charges the time since the previous
+    lap to `stage`; on accelerators the device is synchronized first so queued kernels
+    are charged to the stage that launched them.
+    """
+
+    enabled = True
+
+    def __init__(self, device):
+        self.device = device
+        self.stages = {}
+        self.metrics = {}
+        self._prefill_done = False
+        self._start = self._last = time.perf_counter()
+
+    def lap(self, stage):
+        if self.device.type not in ("cpu", "meta"):
+            getattr(torch, self.device.type).synchronize(self.device)
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self._last
+        self._last = now
+
+    def forward_hook(self, module, args, output):
+        # registered on the LM head for one generate call: its first call ends the prefill
+        if not self._prefill_done:
+            self._prefill_done = True
+            self.lap("prefill")
+
+    def set(self, **metrics):
+        self.metrics.update(metrics)
+
+    def record(self):
+        total = time.perf_counter() - self._start
+        decode = self.stages.get("decode", 0.0)
+        generated = self.metrics.get("generated_tokens", 0)
+        return {
+            "stages_ms": {stage: seconds * 1000 for stage, seconds in self.stages.items()},
+            "total_ms": total * 1000,
+            **self.metrics,
+            "tokens_per_s": generated / decode if decode > 0 else 0.0,
+            # measured around generation (see BaseLLM.generate); cache hits only hold live memory
+            "peak_memory_mb": self.metrics.get("peak_memory_mb", _device_live_memory_mb(self.device)),
+        }
+
+
+class MetricsSink(ABC):
+    """Receives one record per request (see StageTimer.record)."""
+
+    @abstractmethod
+    def emit(self, record):
+        """Consume one per-request record."""
+
+
+class HistogramSink(MetricsSink):
+    """In-memory latency histograms per stage plus token counters."""
+
+    def __init__(self, buckets_ms=LATENCY_BUCKETS_MS):
+        self.buckets_ms = tuple(buckets_ms)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.histograms = {}  # name -> [bucket counts..., +Inf count], sum_ms
+        self.counters = {"requests": 0, "prompt_tokens": 0, "generated_tokens": 0}
+
+    def _observe(self, name, value_ms):
+        counts, total = self.histograms.get(name, ([0] * (len(self.buckets_ms) + 1), 0.0))
+        counts[bisect.bisect_left(self.buckets_ms, value_ms)] += 1
+        self.histograms[name] = (counts, total + value_ms)
+
+    def emit(self, record):
+        with self.lock:
+            for stage, value_ms in record["stages_ms"].items():
+                self._observe(stage, value_ms)
+            self._observe("total", record["total_ms"])
+            self.counters["requests"] += 1
+            self.counters["prompt_tokens"] += record.get("prompt_tokens", 0)
+            self.counters["generated_tokens"] += record.get("generated_tokens", 0)
+
+    def percentile(self, name, q):
+        # upper bound of the bucket holding the q-th quantile
+        counts, _ = self.histograms.get(name, ([], 0.0))
+        target, seen = q * sum(counts), 0
+        for bound, count in zip(self.buckets_ms + (math.inf,), counts):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return 0.0
+
+    def summary(self):
+        with self.lock:
+            return {
+                name: {
+                    "count": sum(counts),
+                    "mean_ms": total / max(sum(counts), 1),
+                    "p50_ms": self.percentile(name, 0.5),
+                    "p95_ms": self.percentile(name, 0.95),
+                }
+                for name, (counts, total) in self.histograms.items()
+            }
+
+
+class PrometheusSink(HistogramSink):
+    """HistogramSink rendered in the Prometheus text exposition format."""
+
+    def __init__(self, path=None, prefix="agent", buckets_ms=LATENCY_BUCKETS_MS):
+        super().__init__(buckets_ms)
+        self.path = path
+        self.prefix = prefix
+
+    def render(self):
+        name = f"{self.prefix}_stage_latency_seconds"
+        lines = [f"# HELP {name} Per-stage request latency.", f"# TYPE {name} histogram"]
+        with self.lock:
+            for stage, (counts, total) in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets_ms + (math.inf,), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else f"{bound / 1000:g}"
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {total / 1000:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {cumulative}')
+            for counter, value in self.counters.items():
+                lines.append(f"# TYPE {self.prefix}_{counter}_total counter")
+                lines.append(f"{self.prefix}_{counter}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path=None):
+        # for the node_exporter textfile collector: write to a temp file, then rename atomically
+        path = path or self.path
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(path + ".tmp", path)
+
+
+class JsonlSink(MetricsSink):
+    """Appends every record as one JSON line."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+# --- Memory Budget ---
+class MemoryBudgetError(RuntimeError):
+    """A request (or the loaded model) does not fit in the configured memory budget."""
+
+
+class MemoryBudget:
+    """
+    Plans KV capacity against a fixed device budget (5 GB on the NPU). Whatever is resident
+    after loading (weights, runtime; RSS on CPU) is static; `reserve_mb` is kept back for
+    activations and allocator slack; the rest is KV cache, counted in tokens.
+    """
+
+    def __init__(self, model, budget_mb, reserve_mb=MEMORY_RESERVE_MB):
+        config = model.config
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        dtype_bytes = torch.finfo(model.dtype).bits // 8
+        self.kv_bytes_per_token = 2 * config.num_hidden_layers * config.num_key_value_heads * head_dim * dtype_bytes
+        self.device = model.device
+        self.budget_mb = budget_mb
+        self.reserve_mb = reserve_mb
+        self.static_mb = _device_live_memory_mb(model.device)
+        available_mb = budget_mb - self.static_mb - reserve_mb
+        if available_mb <= 0:
+            raise MemoryBudgetError(
+                f"Model needs {self.static_mb:.0f}MB + {reserve_mb}MB reserve, budget is {budget_mb}MB."
+            )
+        self.kv_capacity_tokens = int(available_mb * 1024 * 1024 // self.kv_bytes_per_token)
+        self.max_position_embeddings = config.max_position_embeddings
+        self.max_batch_size = 1
+        self.over_budget_requests = 0
+
+    @property
+    def max_context_len(self):
+        return min(self.kv_capacity_tokens, self.max_position_embeddings)
+
+    def reserve_tokens(self, tokens):
+        # long-lived KV (prefix / radix caches) comes out of the capacity left for requests
+        if tokens >= self.kv_capacity_tokens:
+            raise MemoryBudgetError(f"Cannot keep {tokens} cached tokens, capacity is {self.kv_capacity_tokens}.")
+        self.kv_capacity_tokens -= tokens
+
+    def reserve_cache_mb(self, requested_mb, max_fraction=0.5):
+        granted_mb = min(requested_mb, self.kv_capacity_tokens * self.kv_bytes_per_token * max_fraction / (1024 * 1024))
+        self.reserve_tokens(int(granted_mb * 1024 * 1024 // self.kv_bytes_per_token))
+        return granted_mb
+
+    def plan(self, request_tokens):
+        self.max_batch_size = max(1, self.kv_capacity_tokens // request_tokens)
+        return self.summary()
+
+    def fit(self, prompt_tokens, max_new_tokens, batch_size=1):
+        """Returns max_new_tokens trimmed so the batch fits, or raises MemoryBudgetError."""
+        per_row = min(self.max_context_len, self.kv_capacity_tokens // batch_size)
+        if prompt_tokens >= per_row:
+            raise MemoryBudgetError(
+                f"Prompt of {prompt_tokens} tokens x{batch_size} exceeds the budget ({per_row} tokens per row)."
+            )
+        return min(max_new_tokens, per_row - prompt_tokens)
+
+    def check(self, peak_mb):
+        if peak_mb > self.budget_mb:
+            self.over_budget_requests += 1
+            print(f"Warning: request peaked at {peak_mb:.0f}MB, budget is {self.budget_mb}MB.")
+
+    def summary(self):
+        return {
+            "budget_mb": self.budget_mb,
+            "static_mb": round(self.static_mb, 1),
+            "reserve_mb": self.reserve_mb,
+            "kv_mb_per_1k_tokens": round(self.kv_bytes_per_token * 1000 / (1024 * 1024), 1),
+            "kv_capacity_tokens": self.kv_capacity_tokens,
+            "max_context_len": self.max_context_len,
+            "max_batch_size": self.max_batch_size,
+        }
+
+
 # --- Base LLM Class ---
 class BaseLLM:
-    def __init__(self, model_path, lora_weights_path=None):
+    def __init__(
+        self,
+        model_path,
+        lora_weights_path=None,
+        use_prefix_cache=True,
+        radix_cache_max_mb=None,
+        quantization=None,
+        quantized_model_path=None,
+        merged_model_path=None,
+        memory_budget_mb=None,
+        lora_adapters=None,
+        mmap_weights=False,
+    ):
         print("Initializing BaseLLM...")
+        self.model_path = model_path
+        self.lora_weights_path = None
+        self.quantization = None
+        # unmerged multi-adapter mode: name -> path, the active one is switched per request
+        self.adapter_paths = {}
+        self.active_adapter = None
         self.tokenizer = AutoTokenizer.from_pretrained(
             model_path, trust_remote_code=True
         )
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_path,
+        # batched generation needs left padding so every row ends at the generation prompt
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        if lora_adapters:
+            if quantization:
+                raise ValueError("Quantization is not supported together with unmerged LoRA adapters.")
+            self.model = AutoModelForCausalLM.from_pretrained(
+                model_path,
+                trust_remote_code=True,
+                torch_dtype=torch.bfloat16,
+                device_map="auto" if not IS_NPU else {"": "npu"},
+            )
+            for name, path in lora_adapters.items():
+                print(f"Loading LoRA adapter '{name}' from {path}...")
+                if not isinstance(self.model, PeftModel):
+                    self.model = PeftModel.from_pretrained(self.model, path, adapter_name=name)
+                else:
+                    self.model.load_adapter(path, adapter_name=name)
+                self.adapter_paths[name] = path
+            print(f"{len(self.adapter_paths)} LoRA adapters loaded on one shared base model (not merged).")
+        elif quantization and quantized_model_is_current(quantized_model_path, model_path, lora_weights_path, quantization):
+            print(f"Quantized model found at {quantized_model_path}. Loading...")
+            device = "npu" if IS_NPU else ("cuda" if torch.cuda.is_available() else "cpu")
+            self.model, quant_config = load_quantized_model(quantized_model_path, device)
+            self.lora_weights_path = quant_config["lora_weights_path"]
+            self.quantization = f"int{quant_config['bits']}"
+            self.quantization_group_size = quant_config["group_size"]
+        elif merged_model_path and merged_model_is_current(merged_model_path, model_path, lora_weights_path):
+            # safetensors are memory-mapped and already bf16, so there is no merge and no second copy
+            print(f"Merged model found at {merged_model_path}. Loading...")
+            if mmap_weights:
+                # weights shared read-only with every other process mapping the same files (CPU workers)
+                self.model = load_mmap_model(merged_model_path)
+            else:
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    merged_model_path,
+                    trust_remote_code=True,
+                    torch_dtype=torch.bfloat16,
+                    device_map="auto" if not IS_NPU else {"": "npu"},
+                    low_cpu_mem_usage=True,
+                )
+            self.lora_weights_path = lora_weights_path
+            if quantization:
+                self.quantize(quantization)
+        else:
+            self.model = AutoModelForCausalLM.from_pretrained(
+                model_path,
+                trust_remote_code=True,
+                torch_dtype=torch.bfloat16,
+                device_map="auto" if not IS_NPU else {"": "npu"},
+            )
+
+            if lora_weights_path and os.path.exists(lora_weights_path):
+                print(f"LoRA weights found at {lora_weights_path}. Loading...")
+                self.model = PeftModel.from_pretrained(self.model, lora_weights_path)
+                self.model = self.model.merge_and_unload()
+                self.lora_weights_path = lora_weights_path
+                print("LoRA weights loaded and merged successfully.")
+            else:
+                print("No LoRA weights found or path not provided. Using base model.")
+
+            if quantization:
+                self.quantize(quantization)
+
+        self.model.eval()
+
+        self.memory_budget = None
+        if memory_budget_mb:
+            self.memory_budget = MemoryBudget(self.model, memory_budget_mb)
+            if radix_cache_max_mb:
+                radix_cache_max_mb = self.memory_budget.reserve_cache_mb(radix_cache_max_mb)
+
+        # --- System Prompt KV Prefix Cache ---
+        # The system prompt (tool list) is identical for every request, so its
+        # past_key_values are computed once and a copy is handed to every generate call.
+        self.use_prefix_cache = use_prefix_cache
+        self.prefix_cache = None
+        self.system_segment = None
+        # Multi-turn sessions: KV of every served prompt + reply, keyed by a radix tree of token prefixes
+        self.radix_cache = RadixKVCache(radix_cache_max_mb * 1024 * 1024) if radix_cache_max_mb else None
+        # KV depends on the adapter, so every adapter gets its own prefix cache and radix tree
+        self.prefix_caches = {}
+        self.radix_caches = {}
+        if self.adapter_paths:
+            if radix_cache_max_mb:
+                per_adapter_bytes = radix_cache_max_mb * 1024 * 1024 // len(self.adapter_paths)
+                self.radix_caches = {name: RadixKVCache(per_adapter_bytes) for name in self.adapter_paths}
+            self.set_adapter(next(iter(self.adapter_paths)))
+
+        # Set by CustomAgent once the tool list is known (see ToolCallGrammar)
+        self.tool_grammar = None
+        self.last_generation_stats = {}
+        self.draft_model = None
+
+    def set_adapter(self, name):
+        if name == self.active_adapter:
+            return
+        if name not in self.adapter_paths:
+            raise ValueError(f"Unknown LoRA adapter '{name}', loaded: {list(self.adapter_paths)}")
+        self.model.set_adapter(name)
+        self.active_adapter = name
+        self.lora_weights_path = self.adapter_paths[name]
+        self.prefix_cache = self.prefix_caches.get(name)
+        self.radix_cache = self.radix_caches.get(name)
+
+    def export_merged(self, output_dir):
+        # one-off export of the merged weights; later starts load them directly (see merged_model_path)
+        if self.lora_weights_path is None or self.adapter_paths:
+            raise ValueError("No LoRA adapter was merged, nothing to export.")
+        if self.quantization:
+            raise ValueError("Export the merged model before quantizing it.")
+        os.makedirs(output_dir, exist_ok=True)
+        self.model.save_pretrained(output_dir, safe_serialization=True)
+        self.tokenizer.save_pretrained(output_dir)
+        with open(os.path.join(output_dir, MERGE_CONFIG_NAME), "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "base_model_path": self.model_path,
+                    "lora_weights_path": self.lora_weights_path,
+                    "adapter_fingerprint": _adapter_fingerprint(self.lora_weights_path),
+                },
+                f,
+                indent=2,
+            )
+        print(f"Merged model saved to {output_dir}")
+
+    def warmup(self, messages, runs=WARMUP_RUNS, max_new_tokens=16):
+        # first calls pay for kernel selection / allocator growth; do that before serving traffic
+        for _ in range(runs):
+            self.generate(messages, max_new_tokens=max_new_tokens, do_sample=False)
+        self.last_generation_stats = {}
+
+    def quantize(self, quantization, group_size=QUANT_GROUP_SIZE):
+        # quantize the merged weights; the LoRA delta is already folded in by merge_and_unload
+        bits = QUANT_BITS[quantization]
+        replaced = quantize_model(self.model, bits, group_size)
+        self.quantization = quantization
+        self.quantization_group_size = group_size
+        print(f"Quantized {replaced} linear layers to {quantization} (group size {group_size}).")
+
+    def save_quantized(self, output_dir):
+        bits = QUANT_BITS[self.quantization]
+        save_quantized_model(
+            self.model, output_dir, bits, self.quantization_group_size, self.model_path, self.lora_weights_path
+        )
+        self.tokenizer.save_pretrained(output_dir)
+
+    def load_draft_model(self, draft_model_path):
+        # second drafting source for speculative decoding, used when the n-gram lookup finds nothing
+        print(f"Loading draft model from {draft_model_path}...")
+        self.draft_model = AutoModelForCausalLM.from_pretrained(
+            draft_model_path,
             trust_remote_code=True,
-            torch_dtype=torch.bfloat16,
+            torch_dtype=self.model.dtype,
             device_map="auto" if not IS_NPU else {"": "npu"},
         )
+        self.draft_model.eval()
 
-        if lora_weights_path and os.path.exists(lora_weights_path):
-            print(f"LoRA weights found at {lora_weights_path}. Loading...")
-            self.model = PeftModel.from_pretrained(self.model, lora_weights_path)
-            self.model = self.model.merge_and_unload()
-            print("LoRA weights loaded and merged successfully.")
-        else:
-            print("No LoRA weights found or path not provided. Using base model.")
+    def _prefix_cache_key(self, system_prompt):
+        # Any change of prompt or adapter yields a different key, so a stale cache never matches.
+        return (system_prompt, self.lora_weights_path)
 
-        self.model.eval()
+    def has_prefix_cache(self, system_prompt):
+        return self.prefix_cache is not None and self.prefix_cache["key"] == self._prefix_cache_key(system_prompt)
 
-    def generate(self, messages, max_new_tokens=1024, **kwargs):
+    def cache_system_segment(self, system_prompt):
+        """
+        Tokenizes the templated system segment once. Later prompts with the same system
+        prompt only template and tokenize the messages after it (see encode_messages).
+        """
+        text = self.tokenizer.apply_chat_template(
+            [{"role": "system", "content": system_prompt}],
+            tokenize=False,
+            add_generation_prompt=False,
+        )
+        # the same template with an empty system prompt; whatever follows it is the per-request suffix
+        stub = self.tokenizer.apply_chat_template(
+            [{"role": "system", "content": ""}],
+            tokenize=False,
+            add_generation_prompt=False,
+        )
+        self.system_segment = {
+            "system_prompt": system_prompt,
+            "stub": stub,
+            "input_ids": self.tokenizer([text]).input_ids[0],
+        }
+        return self.system_segment["input_ids"]
+
+    def encode_messages(self, messages, timer=NULL_TIMER):
+        """Chat-templated prompt ids of shape [1, seq_len], on the model device."""
+        segment = self.system_segment
+        if segment is not None and messages and messages[0] == {"role": "system", "content": segment["system_prompt"]}:
+            text = self.tokenizer.apply_chat_template(
+                [{"role": "system", "content": ""}] + messages[1:],
+                tokenize=False,
+                add_generation_prompt=True,
+            )
+            timer.lap("template")
+            if text.startswith(segment["stub"]):
+                # the segment ends in <|im_end|>\n and the suffix starts with a special token,
+                # so the two id lists join exactly as the full string would tokenize
+                suffix_ids = self.tokenizer(text[len(segment["stub"]) :], add_special_tokens=False).input_ids
+                input_ids = torch.tensor([segment["input_ids"] + suffix_ids], device=self.model.device)
+                timer.lap("tokenize")
+                return input_ids
         text = self.tokenizer.apply_chat_template(
             messages,
             tokenize=False,
             add_generation_prompt=True,
         )
-        model_inputs = self.tokenizer([text], return_tensors="pt").to(self.model.device)
-        generated_ids = self.model.generate(
-            **model_inputs, max_new_tokens=max_new_tokens, **kwargs
-        )
-        output_ids = generated_ids[0][len(model_inputs.input_ids[0]) :].tolist()
+        timer.lap("template")
+        input_ids = self.tokenizer([text], return_tensors="pt").input_ids.to(self.model.device)
+        timer.lap("tokenize")
+        return input_ids
+
+    def verify_system_segment(self, messages):
+        """Suffix-only encoding must give the same ids as templating and tokenizing the full prompt."""
+        text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        full_ids = self.tokenizer([text]).input_ids[0]
+        return self.encode_messages(messages)[0].tolist() == full_ids
+
+    def build_prefix_cache(self, system_prompt):
+        prefix_ids = torch.tensor([self.cache_system_segment(system_prompt)], device=self.model.device)
+        if self.memory_budget is not None and self.radix_cache is None:
+            # a rebuild replaces the old prefix, only reserve on the first build
+            if self.prefix_cache is None:
+                self.memory_budget.reserve_tokens(prefix_ids.shape[1])
+        with torch.no_grad():
+            # only the KV is needed; logits_to_keep=1 avoids a [prefix_len, vocab] logits tensor
+            outputs = self.model(
+                input_ids=prefix_ids, past_key_values=DynamicCache(), use_cache=True, logits_to_keep=1
+            )
+        self.prefix_cache = {
+            "key": self._prefix_cache_key(system_prompt),
+            "input_ids": prefix_ids,
+            "past_key_values": outputs.past_key_values,
+        }
+        if self.radix_cache is not None:
+            # the radix tree owns the prefix KV from here on, no second copy is kept
+            self.radix_cache.insert(prefix_ids[0].tolist(), outputs.past_key_values)
+            self.prefix_cache["past_key_values"] = None
+        if self.active_adapter is not None:
+            self.prefix_caches[self.active_adapter] = self.prefix_cache
+        print(f"System prompt prefix cache built ({prefix_ids.shape[1]} tokens).")
+
+    def invalidate_prefix_cache(self):
+        self.prefix_cache = None
+        self.prefix_caches = {}
+        if self.radix_cache is not None:
+            self.radix_cache.clear()
+        for radix_cache in self.radix_caches.values():
+            radix_cache.clear()
+
+    def _lookup_prefix_cache(self, messages, input_ids, adapter=None):
+        # adapter: look in that adapter's caches instead of the active one's (ContinuousBatchScheduler)
+        radix_cache, prefix_cache = self.radix_cache, self.prefix_cache
+        if adapter is not None and adapter != self.active_adapter:
+            radix_cache, prefix_cache = self.radix_caches.get(adapter), self.prefix_caches.get(adapter)
+        if radix_cache is not None:
+            return radix_cache.match(input_ids[0].tolist())
+        if prefix_cache is None or not messages or messages[0]["role"] != "system":
+            return None
+        if prefix_cache["key"] != self._prefix_cache_key(messages[0]["content"]):
+            return None
+        prefix_ids = prefix_cache["input_ids"]
+        prefix_len = prefix_ids.shape[1]
+        # generate() needs at least one uncached token to start from
+        if input_ids.shape[1] <= prefix_len or not torch.equal(input_ids[:, :prefix_len], prefix_ids):
+            return None
+        return copy.deepcopy(prefix_cache["past_key_values"])
+
+    def set_tool_grammar(self, tool_schema):
+        self.tool_grammar = ToolCallGrammar(self.tokenizer, tool_schema, self.eos_token_ids())
+
+    def generate(
+        self,
+        messages,
+        max_new_tokens=1024,
+        use_prefix_cache=None,
+        constrained=False,
+        speculative=False,
+        stop_strings=None,
+        timer=NULL_TIMER,
+        adapter=None,
+        **kwargs,
+    ):
+        if adapter is not None:
+            self.set_adapter(adapter)
+        input_ids = self.encode_messages(messages, timer)
+        if self.memory_budget is not None:
+            max_new_tokens = self.memory_budget.fit(input_ids.shape[1], max_new_tokens)
+        model_inputs = BatchEncoding({"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)})
+        if use_prefix_cache is None:
+            use_prefix_cache = self.use_prefix_cache
+        past_key_values = None
+        use_radix_cache = use_prefix_cache and self.radix_cache is not None
+        if use_prefix_cache:
+            past_key_values = self._lookup_prefix_cache(messages, model_inputs.input_ids)
+        if use_radix_cache and past_key_values is None:
+            # keep a handle on the cache generate() fills, so prompt + reply can be stored afterwards
+            past_key_values = DynamicCache()
+        if past_key_values is not None:
+            kwargs["past_key_values"] = past_key_values
+        timer.lap("prefix_cache")
+        prompt_tokens = model_inputs.input_ids.shape[1]
+        # the LM head is called as a module on every path (merged model, PeftModel.generate, and
+        # the direct forwards of the constrained / speculative loops), unlike the top-level model
+        hook = self.model.get_output_embeddings().register_forward_hook(timer.forward_hook) if timer.enabled else None
+        memory = _PeakMemoryMonitor(self.model.device) if timer.enabled or self.memory_budget is not None else None
+        try:
+            if constrained and self.tool_grammar is not None:
+                output_ids, decode_steps = self._generate_constrained(
+                    model_inputs.input_ids, past_key_values, max_new_tokens, stop_strings
+                )
+                stats = {"decode_steps": decode_steps}
+            elif speculative:
+                output_ids, stats = self._generate_speculative(
+                    model_inputs.input_ids, past_key_values, max_new_tokens, stop_strings
+                )
+            else:
+                if stop_strings:
+                    # stop as soon as e.g. </tool> is produced; anything after it is dropped by the caller anyway
+                    kwargs["stop_strings"] = list(stop_strings)
+                    kwargs["tokenizer"] = self.tokenizer
+                generated_ids = self.model.generate(
+                    **model_inputs, max_new_tokens=max_new_tokens, **kwargs
+                )
+                output_ids = generated_ids[0][len(model_inputs.input_ids[0]) :].tolist()
+                stats = {"decode_steps": len(output_ids)}
+        finally:
+            if hook is not None:
+                hook.remove()
+            peak_mb = memory.stop() if memory is not None else None
+        timer.lap("decode")
+        self.last_generation_stats = {"prompt_tokens": prompt_tokens, "generated_tokens": len(output_ids), **stats}
+        if self.memory_budget is not None:
+            self.last_generation_stats["live_memory_mb"] = _device_live_memory_mb(self.model.device)
+            self.last_generation_stats["peak_memory_mb"] = peak_mb
+            self.memory_budget.check(peak_mb)
+        timer.set(prompt_tokens=prompt_tokens, generated_tokens=len(output_ids))
+        if peak_mb is not None:
+            timer.set(peak_memory_mb=peak_mb)
+        if use_radix_cache:
+            self._store_radix(model_inputs.input_ids, output_ids, past_key_values)
         content = self.tokenizer.decode(output_ids, skip_special_tokens=True)
+        timer.lap("detokenize")
         return content
 
+    def _store_radix(self, input_ids, output_ids, past_key_values):
+        # the cache covers every token except the last one sampled
+        cached_len = past_key_values.get_seq_length()
+        token_ids = (input_ids[0].tolist() + output_ids)[:cached_len]
+        self.radix_cache.insert(token_ids, past_key_values)
+
+    @torch.no_grad()
+    def _generate_constrained(self, input_ids, past_key_values, max_new_tokens, stop_strings=None):
+        # Greedy loop with the tool-call grammar. Spans the grammar fully determines
+        # (e.g. the rest of a function name once it is unique) are appended as a whole
+        # and prefilled in a single forward pass instead of one decode step per token.
+        if past_key_values is None:
+            past_key_values = DynamicCache()
+        processor = ToolCallLogitsProcessor(self.tool_grammar, input_ids.shape[1])
+        eos_ids = self.eos_token_ids()
+        pending = input_ids[:, past_key_values.get_seq_length():]
+        sequence = input_ids[0].tolist()
+        output_ids = []
+        decode_steps = 0
+        while len(output_ids) < max_new_tokens:
+            outputs = self.model(input_ids=pending, past_key_values=past_key_values, use_cache=True, logits_to_keep=1)
+            past_key_values = outputs.past_key_values
+            decode_steps += 1
+            scores = processor(torch.tensor([sequence], device=input_ids.device), outputs.logits[:, -1].float())
+            token = int(scores[0].argmax())
+            output_ids.append(token)
+            sequence.append(token)
+            if token in eos_ids:
+                break
+            forced = processor.forced_token_ids(0, sequence)
+            forced = forced[: max_new_tokens - len(output_ids)]
+            output_ids.extend(forced)
+            sequence.extend(forced)
+            if stop_strings and self._hit_stop_string(output_ids, stop_strings):
+                break
+            pending = torch.tensor([[token] + forced], device=input_ids.device)
+        return output_ids, decode_steps
+
+    @torch.no_grad()
+    def _generate_speculative(self, input_ids, past_key_values, max_new_tokens, stop_strings=None):
+        # Greedy speculative decoding. Draft tokens come from n-gram lookup over the prompt
+        # (conversation + tool list), since slot values are mostly copied from the user turn;
+        # the draft model is the fallback source. All drafts are verified in one forward pass
+        # and only the prefix matching the target model's own argmax is kept.
+        if past_key_values is None:
+            past_key_values = DynamicCache()
+        eos_ids = self.eos_token_ids()
+        device = input_ids.device
+        sequence = input_ids[0].tolist()
+        outputs = self.model(
+            input_ids=input_ids[:, past_key_values.get_seq_length():],
+            past_key_values=past_key_values,
+            use_cache=True,
+            logits_to_keep=1,
+        )
+        past_key_values = outputs.past_key_values
+        output_ids = [int(outputs.logits[0, -1].argmax())]
+        decode_steps, drafted, accepted_total = 1, 0, 0
+        draft_state = {"cache": DynamicCache(), "length": 0}
+
+        def finished():
+            return (
+                output_ids[-1] in eos_ids
+                or len(output_ids) >= max_new_tokens
+                or (stop_strings and self._hit_stop_string(output_ids, stop_strings))
+            )
+
+        while not finished():
+            context = sequence + output_ids
+            draft = self._ngram_draft(context)
+            if not draft and self.draft_model is not None:
+                draft = self._model_draft(context, draft_state)
+            draft = draft[: max_new_tokens - len(output_ids)]
+
+            outputs = self.model(
+                input_ids=torch.tensor([[output_ids[-1]] + draft], device=device),
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            past_key_values = outputs.past_key_values
+            decode_steps += 1
+            predictions = outputs.logits[0].argmax(dim=-1).tolist()
+            accepted = 0
+            while accepted < len(draft) and draft[accepted] == predictions[accepted]:
+                accepted += 1
+            drafted += len(draft)
+            accepted_total += accepted
+            # drop the KV of rejected draft tokens
+            past_key_values.crop(past_key_values.get_seq_length() - (len(draft) - accepted))
+            if self.draft_model is not None:
+                draft_state["length"] = min(draft_state["length"], len(context) + accepted)
+                draft_state["cache"].crop(draft_state["length"])
+
+            for token in draft[:accepted] + [predictions[accepted]]:
+                output_ids.append(token)
+                if finished():
+                    break
+
+        stats = {
+            "decode_steps": decode_steps,
+            "drafted_tokens": drafted,
+            "accepted_tokens": accepted_total,
+            "acceptance_rate": accepted_total / drafted if drafted else 0.0,
+        }
+        return output_ids, stats
+
+    @staticmethod
+    def _ngram_draft(context, num_draft_tokens=NUM_DRAFT_TOKENS, max_ngram_size=MAX_NGRAM_SIZE):
+        # most recent earlier occurrence of the trailing n-gram, longest n first
+        for n in range(max_ngram_size, 0, -1):
+            if len(context) <= n:
+                continue
+            tail = context[-n:]
+            for start in range(len(context) - n - 1, -1, -1):
+                if context[start : start + n] == tail:
+                    continuation = context[start + n : start + n + num_draft_tokens]
+                    if continuation:
+                        return continuation
+        return []
+
+    def _model_draft(self, context, draft_state, num_draft_tokens=NUM_DRAFT_TOKENS):
+        # greedy tokens from the draft model; its cache keeps the already-verified prefix
+        cache = draft_state["cache"]
+        device = self.draft_model.device
+        pending = context[draft_state["length"]:]
+        draft = []
+        for _ in range(num_draft_tokens):
+            outputs = self.draft_model(
+                input_ids=torch.tensor([pending], device=device), past_key_values=cache, use_cache=True
+            )
+            draft_state["length"] += len(pending)
+            token = int(outputs.logits[0, -1].argmax())
+            draft.append(token)
+            pending = [token]
+        return draft
+
+    def _hit_stop_string(self, output_ids, stop_strings):
+        tail = self.tokenizer.decode(output_ids[-16:], skip_special_tokens=True)
+        return any(stop in tail for stop in stop_strings)
+
+    def generate_batch(
+        self,
+        messages_list,
+        max_new_tokens=1024,
+        stop_strings=("</tool>",),
+        constrained=False,
+        adapters=None,
+        **kwargs,
+    ):
+        # Prefix cache is not used here: left padding puts pad tokens in front of the
+        # system prompt, so the cached KV would no longer line up with the row positions.
+        if adapters is not None:
+            unknown = set(adapters) - set(self.adapter_paths)
+            if unknown:
+                raise ValueError(f"Unknown LoRA adapters {sorted(unknown)}, loaded: {list(self.adapter_paths)}")
+            # peft splits the batch by adapter name and applies each LoRA delta only to its own rows,
+            # so one forward serves a mixed batch on the shared base weights
+            kwargs["adapter_names"] = list(adapters)
+        rows = [self.encode_messages(messages)[0].tolist() for messages in messages_list]
+        model_inputs = self.tokenizer.pad({"input_ids": rows}, return_tensors="pt").to(self.model.device)
+        if self.memory_budget is not None:
+            max_new_tokens = self.memory_budget.fit(model_inputs.input_ids.shape[1], max_new_tokens, len(rows))
+        if constrained and self.tool_grammar is not None:
+            # plain logits masking; forced spans need the custom loop used by generate()
+            kwargs["logits_processor"] = LogitsProcessorList(
+                [ToolCallLogitsProcessor(self.tool_grammar, model_inputs.input_ids.shape[1])]
+            )
+        generated_ids = self.model.generate(
+            **model_inputs,
+            max_new_tokens=max_new_tokens,
+            stop_strings=list(stop_strings),
+            tokenizer=self.tokenizer,
+            pad_token_id=self.tokenizer.pad_token_id,
+            **kwargs,
+        )
+        # rows that stopped early are padded up to the longest row; pads are skipped on decode
+        output_ids = generated_ids[:, model_inputs.input_ids.shape[1] :]
+        return self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+
+    def verify_prefix_cache(self, messages, max_new_tokens=128):
+        """Greedy output must be identical with and without the prefix cache."""
+        without_cache = self.generate(messages, max_new_tokens=max_new_tokens, use_prefix_cache=False, do_sample=False)
+        with_cache = self.generate(messages, max_new_tokens=max_new_tokens, use_prefix_cache=True, do_sample=False)
+        return without_cache == with_cache, without_cache, with_cache
+
+    def eos_token_ids(self):
+        eos_ids = self.model.generation_config.eos_token_id
+        if eos_ids is None:
+            eos_ids = []
+        elif isinstance(eos_ids, int):
+            eos_ids = [eos_ids]
+        return set(eos_ids) | {self.tokenizer.eos_token_id}
+
+
+def extract_tool_call(response_content):
+    tool_calls = re.findall(r"<tool>(.*?)</tool>", response_content, re.DOTALL)
+    if tool_calls:
+        tool_call = tool_calls[-1].strip()
+        if "(" not in tool_call and ")" not in tool_call:
+            tool_call += "()"
+        return tool_call
+    else:
+        return response_content.strip()
+
+
+# --- History Compaction ---
+# shared with the training scripts (src/train_utils.py) so training sees the same compacted histories
+_CALL_PATTERN = re.compile(r"[A-Z][A-Za-z]*\(")
+COMPACTED_HISTORY_NOTE = "（更早的对话已省略，以下为已执行的指令）"
+
+
+def compact_history(messages, tokenizer=None, max_tokens=HISTORY_MAX_TOKENS, keep_rounds=HISTORY_KEEP_ROUNDS):
+    """
+    Token-budgeted compaction of a user/assistant history (no system message). Once the history
+    is over max_tokens, every turn before the last `keep_rounds` executed rounds is folded into one
+    user/assistant pair whose reply lists the calls already executed, so the "already executed"
+    rule still sees them. The pending tail (clarification questions and the user's answers since
+    the last executed call) is always kept word for word.
+    """
+    if not max_tokens or len(messages) < 3:
+        return messages
+
+    def count_tokens(text):
+        return len(tokenizer.encode(text, add_special_tokens=False)) if tokenizer is not None else len(text)
+
+    if sum(count_tokens(turn["content"]) for turn in messages) <= max_tokens:
+        return messages
+    # indices of assistant turns that executed calls; a reply without a call is a clarification
+    executed = [
+        i for i, turn in enumerate(messages)
+        if turn["role"] == "assistant" and _CALL_PATTERN.search(turn["content"])
+    ]
+    if len(executed) <= keep_rounds:
+        return messages
+    # everything after this executed turn is kept verbatim
+    boundary = executed[-keep_rounds - 1] if keep_rounds else executed[-1]
+    folded_calls = [
+        extract_tool_call(messages[i]["content"]) for i in executed if i <= boundary
+    ]
+    summary = [
+        {"role": "user", "content": COMPACTED_HISTORY_NOTE},
+        {"role": "assistant", "content": "|".join(folded_calls)},
+    ]
+    return summary + messages[boundary + 1 :]
+
+
+# --- Streaming Tool-Call Parser ---
+class ToolCallStreamParser:
+    """
+    Incremental version of extract_tool_call: feed() decoded text as it arrives and get back
+    every call inside <tool>...</tool> that is complete, i.e. closed by its top-level ")" or
+    cut off by a "|" separator. A segment only counts as a call once it starts like one
+    ("Name("); anything else (a clarification question) is held back until </tool> and comes
+    out whole. finish() returns what is left once decoding stops.
+    """
+
+    OPEN_TAG = "<tool>"
+    CLOSE_TAG = "</tool>"
+    CALL_START = re.compile(r"[A-Z]\w*")
 
-#较短的提示词
-class CustomAgent:
     def __init__(self):
-        print("Initializing CustomAgent...")
-        base_model_path = "models/Qwen3-1.7B"
-        lora_weights_path = "./lora_weights/"
+        self.text = ""
+        self.pos = 0
+        self.inside = False
+        self.closed = False
+        self.call_start = None
+        self.mode = None  # per segment: None until it is known to be a "call" or plain "text"
+        self.depth = 0
+        self.in_quote = False
+        self.emitted = 0
+
+    def feed(self, delta):
+        self.text += delta
+        calls = []
+        while not self.closed:
+            if not self.inside:
+                start = self.text.find(self.OPEN_TAG, self.pos)
+                if start < 0:
+                    # keep a possible partial "<tool" at the end for the next chunk
+                    self.pos = max(self.pos, len(self.text) - len(self.OPEN_TAG) + 1)
+                    break
+                self.inside = True
+                self.pos = self.call_start = start + len(self.OPEN_TAG)
+                continue
+            if self.pos >= len(self.text):
+                break
+            char = self.text[self.pos]
+            if char == "<" and not self.in_quote:
+                rest = self.text[self.pos :]
+                if rest.startswith(self.CLOSE_TAG):
+                    self._emit(calls, self.pos)
+                    self.closed = True
+                    break
+                if self.CLOSE_TAG.startswith(rest):
+                    break  # partial closing tag, wait for more text
+            if self.mode is None:
+                if char.isspace() or char == "|":
+                    self.pos += 1
+                    continue
+                match = self.CALL_START.match(self.text, self.pos)
+                if match is None:
+                    self.mode = "text"
+                elif match.end() == len(self.text):
+                    break  # still reading the name, wait for more text
+                else:
+                    self.mode = "call" if self.text[match.end()] == "(" else "text"
+            if self.mode == "call":
+                if char == '"':
+                    self.in_quote = not self.in_quote
+                elif not self.in_quote:
+                    if char == "(":
+                        self.depth += 1
+                    elif char == ")":
+                        self.depth = max(self.depth - 1, 0)
+                        if self.depth == 0:
+                            self._emit(calls, self.pos + 1)
+                    elif char == "|" and self.depth == 0:
+                        self._emit(calls, self.pos)
+                        self.call_start = self.pos + 1
+            self.pos += 1
+        return calls
+
+    def finish(self):
+        """Remaining calls after the last chunk, with the same fallbacks as extract_tool_call."""
+        if not self.inside:
+            # no <tool> block at all: extract_tool_call returns the whole reply
+            return [] if self.emitted else [self.text.strip()] if self.text.strip() else []
+        calls = []
+        # a call cut off mid-arguments (token budget ran out) is never handed to the device
+        if not self.closed and self.depth == 0 and not self.in_quote:
+            self._emit(calls, len(self.text))
+        return calls
+
+    def _emit(self, calls, end):
+        call = self.text[self.call_start : end].strip().strip("|").strip()
+        self.call_start = end
+        self.mode = None
+        if not call:
+            return
+        if "(" not in call and ")" not in call:
+            call += "()"
+        calls.append(call)
+        self.emitted += 1
 
-        self.llm = BaseLLM(base_model_path, lora_weights_path)
-        self.system_prompt = f"""
+
+
+# --- Radix-Tree KV Cache ---
+class _RadixNode:
+    def __init__(self, tokens=(), kv=None, parent=None):
+        self.tokens = tokens    # token ids on the edge leading into this node
+        self.kv = kv            # per layer (key, value) covering exactly self.tokens
+        self.parent = parent
+        self.children = {}      # first token id -> child node
+        self.last_access = 0
+        self.nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv) if kv else 0
+
+
+class RadixKVCache:
+    """
+    KV cache keyed by a radix tree of token prefixes. Every node stores the KV of its own
+    edge only, so a shared prefix (system prompt, earlier turns) is held once. A lookup
+    returns the KV of the longest cached prefix, which for turn N+1 of a session is the
+    whole of turn N including the assistant reply. Least-recently-used leaves are evicted
+    once the stored KV exceeds max_bytes.
+
+    The reply is keyed by the tokens that were generated, so turn N is reused in full only
+    when the client sends back the raw model output (e.g. "<tool>...</tool>") as the assistant
+    turn. CustomAgent.run() returns the extracted call; echoing that instead matches up to the
+    start of the assistant turn, and the reply and everything after it is prefilled again.
+    utils/check_radix_cache.py shows both cases.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.root = _RadixNode()
+        self.total_bytes = 0
+        self.clock = 0
+        self.lookups = 0
+        self.hits = 0
+        self.lookup_tokens = 0
+        self.hit_tokens = 0
+        self.evictions = 0
+
+    def clear(self):
+        self.root = _RadixNode()
+        self.total_bytes = 0
+
+    def _tick(self, node):
+        self.clock += 1
+        while node is not None:
+            node.last_access = self.clock
+            node = node.parent
+
+    def match(self, token_ids):
+        """DynamicCache for the longest cached prefix of token_ids (at most len - 1 tokens), or None."""
+        self.lookups += 1
+        self.lookup_tokens += len(token_ids)
+        limit = len(token_ids) - 1  # generate() needs one uncached token
+        node, matched, segments = self.root, 0, []
+        while matched < limit:
+            child = node.children.get(token_ids[matched])
+            if child is None:
+                break
+            n = _common_prefix_len(child.tokens, token_ids[matched:limit])
+            segments.append((child, n))
+            matched += n
+            if n < len(child.tokens):
+                break
+            node = child
+        if matched == 0:
+            return None
+        self._tick(segments[-1][0])
+        self.hits += 1
+        self.hit_tokens += matched
+        legacy = []
+        for layer in range(len(segments[0][0].kv)):
+            keys = torch.cat([seg.kv[layer][0][:, :, :n] for seg, n in segments], dim=2)
+            values = torch.cat([seg.kv[layer][1][:, :, :n] for seg, n in segments], dim=2)
+            legacy.append((keys, values))
+        return DynamicCache.from_legacy_cache(tuple(legacy))
+
+    def insert(self, token_ids, past_key_values):
+        """Stores the KV of token_ids; past_key_values must cover at least these tokens (extra positions are dropped)."""
+        kv = past_key_values.to_legacy_cache() if hasattr(past_key_values, "to_legacy_cache") else past_key_values
+        node, pos = self.root, 0
+        while pos < len(token_ids):
+            child = node.children.get(token_ids[pos])
+            if child is None:
+                tokens = tuple(token_ids[pos:])
+                # the cache can hold more positions than tokens (stop string / speculative finish),
+                # the node must cover exactly its own tokens
+                end = len(token_ids)
+                new_kv = [(k[:, :, pos:end].clone(), v[:, :, pos:end].clone()) for k, v in kv]
+                leaf = _RadixNode(tokens, new_kv, node)
+                node.children[tokens[0]] = leaf
+                self.total_bytes += leaf.nbytes
+                node = leaf
+                break
+            n = _common_prefix_len(child.tokens, token_ids[pos:])
+            if n < len(child.tokens):
+                child = self._split(child, n)
+            pos += n
+            node = child
+        self._tick(node)
+        self._evict()
+
+    def _split(self, child, n):
+        # child keeps the tail of its edge, a new middle node takes the first n tokens
+        parent = child.parent
+        head_kv = [(k[:, :, :n].clone(), v[:, :, :n].clone()) for k, v in child.kv]
+        tail_kv = [(k[:, :, n:].clone(), v[:, :, n:].clone()) for k, v in child.kv]
+        middle = _RadixNode(child.tokens[:n], head_kv, parent)
+        middle.last_access = child.last_access
+        parent.children[child.tokens[0]] = middle
+        self.total_bytes -= child.nbytes
+        child.tokens, child.kv, child.parent = child.tokens[n:], tail_kv, middle
+        child.nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in tail_kv)
+        middle.children[child.tokens[0]] = child
+        self.total_bytes += middle.nbytes + child.nbytes
+        return middle
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            leaves = []
+            stack = [self.root]
+            while stack:
+                node = stack.pop()
+                if node is not self.root and not node.children:
+                    leaves.append(node)
+                stack.extend(node.children.values())
+            if not leaves:
+                return
+            victim = min(leaves, key=lambda leaf: leaf.last_access)
+            del victim.parent.children[victim.tokens[0]]
+            self.total_bytes -= victim.nbytes
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "lookups": self.lookups,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "token_hit_rate": self.hit_tokens / self.lookup_tokens if self.lookup_tokens else 0.0,
+            "memory_mb": self.total_bytes / 1024 / 1024,
+            "max_memory_mb": self.max_bytes / 1024 / 1024,
+            "evictions": self.evictions,
+        }
+
+
+def _common_prefix_len(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+# --- Tool Schema & Grammar-Constrained Decoding ---
+def parse_tool_schema(system_prompt):
+    """
+    Parses the "# 工具列表" section of the system prompt into
+    {function name: {param name: (type, enum values, closed)}}.
+    An enum is closed when the prompt lists no "..." after its values.
+    """
+    schema = {}
+    for line in system_prompt.splitlines():
+        match = re.match(r"^\s*([A-Z][A-Za-z]*)\((.*)\) - ", line)
+        if not match:
+            continue
+        params = {}
+        for param, spec in re.findall(r"(\w+):\[([^\]]*)\]", match.group(2)):
+            parts = spec.split("|")
+            values = [v for v in parts[1:] if v != "..."]
+            params[param] = (parts[0], values, bool(values) and "..." not in parts)
+        schema[match.group(1)] = params
+    return schema
+
+
+def _bytes_to_unicode():
+    # byte <-> printable unicode table used by byte-level BPE tokenizers (GPT-2 / Qwen)
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(2 ** 8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2 ** 8 + n)
+            n += 1
+    return dict(zip(bs, [chr(c) for c in cs]))
+
+
+class ToolCallGrammar:
+    """
+    Byte-level grammar of `<tool>Func(Arg="v", ...)|Func2()</tool>` built from the tool
+    schema. Function names, parameter names and closed enum values are matched against
+    precomputed option tries; free-text values are left unconstrained. A reply that does
+    not start with a function name (a clarification question) is also left unconstrained,
+    since the training data wraps those in <tool> as well.
+    """
+
+    def __init__(self, tokenizer, tool_schema, eos_ids):
+        self.tokenizer = tokenizer
+        self.eos_ids = set(eos_ids)
+        self.functions = {}
+        for name, params in tool_schema.items():
+            self.functions[name] = {
+                param: self._value_options(param_type, values, closed)
+                for param, (param_type, values, closed) in params.items()
+            }
+        self.name_options = [name.encode() + b"(" for name in self.functions]
+
+        byte_decoder = {c: b for b, c in _bytes_to_unicode().items()}
+        special_ids = set(tokenizer.all_special_ids) | set(tokenizer.added_tokens_decoder)
+        self.token_bytes = []
+        for token_id in range(len(tokenizer)):
+            token = tokenizer.convert_ids_to_tokens(token_id)
+            if token_id in special_ids or token is None:
+                self.token_bytes.append(None)
+            elif all(c in byte_decoder for c in token):
+                self.token_bytes.append(bytes(byte_decoder[c] for c in token))
+            else:
+                self.token_bytes.append(tokenizer.decode([token_id]).encode("utf-8"))
+
+        self.ids_by_bytes = {}
+        for token_id, data in enumerate(self.token_bytes):
+            if data:
+                self.ids_by_bytes.setdefault(data, []).append(token_id)
+        self.sorted_bytes = sorted(self.ids_by_bytes)
+        self.max_token_len = max(len(data) for data in self.sorted_bytes)
+        # tokens that can open a clarification question (first byte outside ASCII)
+        self.text_start_ids = [i for i, data in enumerate(self.token_bytes) if data and data[0] >= 0x80]
+        self._allowed_cache = {}
+
+    @staticmethod
+    def _value_options(param_type, values, closed):
+        if set(values) == {"True", "False"}:
+            return [b"True", b"False"]
+        if param_type == "Str" and closed:
+            return [b'"' + v.encode() + b'"' for v in values]
+        return None  # free value
+
+    def initial_state(self):
+        return _ToolCallState()
+
+    def allowed_token_ids(self, state):
+        """Token ids allowed in this state, or None when the position is unconstrained."""
+        if state.mode == "done":
+            return sorted(self.eos_ids)
+        if state.mode not in _CONSTRAINED_MODES:
+            return None
+        key = state.key()
+        if key in self._allowed_cache:
+            return self._allowed_cache[key]
+
+        allowed = set()
+        for rest in state.remaining_options(self):
+            # tokens that end inside this option
+            for length in range(1, min(len(rest), self.max_token_len) + 1):
+                allowed.update(self.ids_by_bytes.get(rest[:length], ()))
+            # tokens that run past it; keep them only if the grammar still accepts
+            start = bisect.bisect_right(self.sorted_bytes, rest)
+            while start < len(self.sorted_bytes) and self.sorted_bytes[start].startswith(rest):
+                data = self.sorted_bytes[start]
+                probe = state.copy()
+                probe.feed(self, data)
+                if probe.mode != "dead":
+                    allowed.update(self.ids_by_bytes[data])
+                start += 1
+        if state.mode == "name" and state.first_call and not state.buf:
+            allowed.update(self.text_start_ids)
+        allowed = sorted(allowed)
+        self._allowed_cache[key] = allowed
+        return allowed
+
+    def forced_bytes(self, state):
+        """Bytes the grammar fully determines from this state on (may cross several segments)."""
+        forced = b""
+        probe = state.copy()
+        while probe.mode in _CONSTRAINED_MODES:
+            if probe.mode == "name" and probe.first_call and not probe.buf:
+                break
+            options = probe.remaining_options(self)
+            if len(options) != 1:
+                break
+            forced += options[0]
+            probe.feed(self, options[0])
+        return forced
+
+
+_CONSTRAINED_MODES = ("open", "name", "param_or_close", "param", "value", "after_value", "after_call")
+
+
+class _ToolCallState:
+    def __init__(self):
+        self.mode = "open"
+        self.buf = b""
+        self.first_call = True
+        self.function = None
+        self.param = None
+        self.used = ()
+        self.quoted = None
+        self.text_tail = b""
+
+    def copy(self):
+        state = _ToolCallState.__new__(_ToolCallState)
+        state.__dict__.update(self.__dict__)
+        return state
+
+    def key(self):
+        return (self.mode, self.buf, self.first_call, self.function, self.param, self.used)
+
+    def options(self, grammar):
+        if self.mode == "open":
+            return [b"<tool>"]
+        if self.mode == "name":
+            return grammar.name_options
+        params = grammar.functions.get(self.function, {})
+        unused = [p.encode() + b"=" for p in params if p not in self.used]
+        if self.mode == "param_or_close":
+            return unused + [b")"]
+        if self.mode == "param":
+            return unused + [b" " + p for p in unused]
+        if self.mode == "value":
+            return params[self.param]
+        if self.mode == "after_value":
+            return [b",", b")"]
+        if self.mode == "after_call":
+            return [b"|", b"</tool>"]
+        return []
+
+    def remaining_options(self, grammar):
+        return [o[len(self.buf):] for o in self.options(grammar) if o.startswith(self.buf)]
+
+    def feed(self, grammar, data):
+        for byte in data:
+            self._feed_byte(grammar, byte)
+
+    def _feed_byte(self, grammar, byte):
+        char = bytes([byte])
+        if self.mode in _CONSTRAINED_MODES:
+            if self.mode == "name" and self.first_call and not self.buf and byte >= 0x80:
+                self.mode, self.text_tail = "text", char
+                return
+            self.buf += char
+            options = [o for o in self.options(grammar) if o.startswith(self.buf)]
+            if not options:
+                self.mode = "dead"
+            elif self.buf in options:
+                option, self.buf = self.buf, b""
+                self._complete(grammar, option)
+        elif self.mode == "free":
+            if self.quoted is None:
+                self.quoted = char == b'"'
+                if self.quoted:
+                    return
+            if self.quoted and char == b'"':
+                self.mode = "after_value"
+            elif not self.quoted and char in (b",", b")"):
+                self.mode = "after_value"
+                self._feed_byte(grammar, byte)
+        elif self.mode == "text":
+            self.text_tail = (self.text_tail + char)[-7:]
+            if self.text_tail == b"</tool>":
+                self.mode = "done"
+        elif self.mode == "done":
+            self.mode = "dead"
+
+    def _complete(self, grammar, option):
+        if self.mode == "open":
+            self.mode = "name"
+        elif self.mode == "name":
+            self.function, self.used = option[:-1].decode(), ()
+            self.mode = "param_or_close"
+        elif self.mode in ("param_or_close", "param"):
+            if option == b")":
+                self.mode = "after_call"
+                return
+            self.param = option.strip()[:-1].decode()
+            self.used = self.used + (self.param,)
+            if grammar.functions[self.function][self.param] is None:
+                self.mode, self.quoted = "free", None
+            else:
+                self.mode = "value"
+        elif self.mode == "value":
+            self.mode = "after_value"
+        elif self.mode == "after_value":
+            self.mode = "param" if option == b"," else "after_call"
+        elif self.mode == "after_call":
+            if option == b"|":
+                self.mode, self.first_call = "name", False
+            else:
+                self.mode = "done"
+
+
+class ToolCallLogitsProcessor(LogitsProcessor):
+    """Masks tokens that would leave the tool-call grammar; one parser state per batch row."""
+
+    def __init__(self, grammar, prompt_len):
+        self.grammar = grammar
+        self.prompt_len = prompt_len
+        self.states = {}
+        self.consumed = {}
+
+    def _sync(self, row, sequence):
+        state = self.states.setdefault(row, self.grammar.initial_state())
+        start = self.prompt_len + self.consumed.get(row, 0)
+        for token_id in list(sequence[start:]):
+            data = self.grammar.token_bytes[int(token_id)]
+            if data:
+                state.feed(self.grammar, data)
+        self.consumed[row] = len(sequence) - self.prompt_len
+        return state
+
+    def __call__(self, input_ids, scores):
+        for row in range(input_ids.shape[0]):
+            state = self._sync(row, input_ids[row].tolist())
+            allowed = self.grammar.allowed_token_ids(state)
+            if not allowed:
+                continue
+            mask = torch.full_like(scores[row], float("-inf"))
+            mask[allowed] = 0
+            scores[row] = scores[row] + mask
+        return scores
+
+    def forced_token_ids(self, row, sequence):
+        state = self._sync(row, sequence)
+        forced = self.grammar.forced_bytes(state)
+        if not forced:
+            return []
+        try:
+            text = forced.decode("utf-8")
+        except UnicodeDecodeError:
+            return []  # previous token ended inside a multi-byte character
+        return self.grammar.tokenizer.encode(text, add_special_tokens=False)
+
+
+# --- Tool Retrieval (prompt pruning) ---
+_TERM_ALIASES = {
+    "wifi": ["wlan"], "无线": ["wlan"], "热点": ["hotshot"], "快捷键": ["shortcut"],
+    "电话": ["联系", "call"], "关机": ["shut"], "音乐": ["music"], "小说": ["voice"], "听": ["voice"],
+    "视频": ["video"], "剩多少电": ["battery", "level"], "搜": ["search"], "投影": ["external"],
+    "放点": ["播放"], "音响": ["音箱"], "声音": ["音频"],
+}
+_CLAUSE_SPLIT = r"[，,。；;！!？?\n]|然后|并且|另外|顺便|还有|最后|同时"
+
+
+def _lexical_terms(text):
+    # ASCII words split on camel case, CJK runs as character bigrams (unigrams are too noisy)
+    terms = []
+    for word in re.findall(r"[A-Za-z]+|\d+", text):
+        for part in re.findall(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+", word):
+            terms.append(part.lower())
+    for run in re.findall(r"[\u4e00-\u9fff]+", text):
+        if len(run) == 1:
+            terms.append(run)
+        terms.extend(run[i : i + 2] for i in range(len(run) - 1))
+    aliases = []
+    lowered = text.lower()
+    for key, values in _TERM_ALIASES.items():
+        if key in lowered:
+            aliases.extend(values)
+    return terms + aliases
+
+
+class ToolRetriever:
+    """
+    BM25 over character n-grams of each tool line (name, parameters, enum values and
+    description). Built once from the system prompt, CPU only. select() returns the
+    top-k tool names for a conversation, or None when the ranking is not confident
+    enough, in which case the caller keeps the full tool list.
+    """
+
+    def __init__(
+        self, system_prompt, top_k=TOOL_RETRIEVAL_TOP_K, per_clause_k=5, min_score=2.0, flat_ratio=0.8, k1=1.5, b=0.75
+    ):
+        self.system_prompt = system_prompt
+        self.top_k = top_k
+        self.per_clause_k = per_clause_k
+        self.min_score = min_score
+        self.flat_ratio = flat_ratio
+        self.k1 = k1
+        self.b = b
+
+        self.tool_lines = {}
+        docs = {}
+        for line in system_prompt.splitlines():
+            match = re.match(r"^\s*([A-Z][A-Za-z]*)\(.*\) - ", line)
+            if match:
+                self.tool_lines[match.group(1)] = line
+                docs[match.group(1)] = _lexical_terms(line)
+
+        self.doc_term_freqs = {}
+        self.doc_lens = {}
+        doc_freqs = {}
+        for name, terms in docs.items():
+            freqs = {}
+            for term in terms:
+                freqs[term] = freqs.get(term, 0) + 1
+            self.doc_term_freqs[name] = freqs
+            self.doc_lens[name] = len(terms)
+            for term in freqs:
+                doc_freqs[term] = doc_freqs.get(term, 0) + 1
+        num_docs = len(docs)
+        self.avg_doc_len = sum(self.doc_lens.values()) / max(num_docs, 1)
+        self.idf = {
+            term: math.log(1 + (num_docs - df + 0.5) / (df + 0.5)) for term, df in doc_freqs.items()
+        }
+
+    def score(self, query):
+        query_terms = set(_lexical_terms(query))
+        scores = {}
+        for name, freqs in self.doc_term_freqs.items():
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lens[name] / self.avg_doc_len)
+            total = 0.0
+            for term in query_terms:
+                tf = freqs.get(term)
+                if tf:
+                    total += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            scores[name] = total
+        return scores
+
+    def select(self, input_messages, top_k=None):
+        top_k = top_k or self.top_k
+        query = "\n".join(m["content"] for m in input_messages if m["role"] == "user")
+        ranked = sorted(self.score(query).items(), key=lambda item: item[1], reverse=True)
+        if not ranked or ranked[0][1] < self.min_score:
+            return None
+        if len(ranked) > top_k and ranked[top_k][1] >= self.flat_ratio * ranked[0][1]:
+            return None  # scores too flat to cut safely
+        selected = {name for name, _ in ranked[:top_k]}
+        # multi-instruction utterances dilute the global ranking, so every clause
+        # also contributes its own best few tools
+        for clause in re.split(_CLAUSE_SPLIT, query):
+            if clause.strip():
+                clause_scores = self.score(clause)
+                best = sorted(clause_scores, key=clause_scores.get, reverse=True)[: self.per_clause_k]
+                selected.update(name for name in best if clause_scores[name] > 0)
+        # tools already called in the history stay visible for the "already executed" check
+        for message in input_messages:
+            if message["role"] == "assistant":
+                selected.update(n for n in re.findall(r"([A-Z][A-Za-z]*)\(", message["content"]) if n in self.tool_lines)
+        return selected
+
+    def build_prompt(self, input_messages, top_k=None):
+        selected = self.select(input_messages, top_k)
+        if selected is None:
+            return self.system_prompt
+        # keep the original order of the tool list, only drop unselected lines
+        dropped = {line for name, line in self.tool_lines.items() if name not in selected}
+        lines = [line for line in self.system_prompt.splitlines(keepends=True) if line.rstrip("\n") not in dropped]
+        return "".join(lines)
+
+
+# --- Response Cache ---
+def normalize_utterance(text):
+    # equivalent voice commands should share a key: wake word, whitespace and trailing punctuation are dropped
+    text = text.strip()
+    for wake_word in WAKE_WORDS:
+        if text.startswith(wake_word):
+            text = text[len(wake_word):].lstrip(" ，,、。.!！~～")
+    text = re.sub(r"\s+", " ", text).strip()
+    text = re.sub(r" ?([^\x00-\x7f]) ?", r"\1", text)  # spaces next to CJK characters carry no meaning
+    return text.rstrip(" 。.！!？?～~，,、")
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache of run() results. Decoding is greedy, so the output only depends on
+    the messages; the key is a hash of the normalized messages plus a fingerprint of the
+    model, adapter and system prompt, so entries never outlive a model or prompt change.
+    """
+
+    def __init__(self, max_entries, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def make_key(fingerprint, input_messages):
+        normalized = [
+            [m["role"], normalize_utterance(m["content"]) if m["role"] == "user" else m["content"].strip()]
+            for m in input_messages
+        ]
+        payload = json.dumps([fingerprint, normalized], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            self.entries = OrderedDict(json.load(f))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        print(f"Loaded {len(self.entries)} cached responses from {self.path}")
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(list(self.entries.items()), f, ensure_ascii=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# --- Zero-LLM Fast Path ---
+_LEADING_FILLERS = ("请帮我", "麻烦你", "麻烦", "帮我", "给我", "请")
+_TRAILING_FILLERS = ("一下", "吧", "呢", "啊", "呀", "哦", "嘛")
+_CALL_ARGUMENT = re.compile(r'(\w+)=("[^"]*"|[^,)]+)')
+# a near match that differs in any of these may ask for the opposite action or another value
+_CONTRADICTING_CHARS = set("开关启停闭禁允增减加降升高低大小上下前后零一二三四五六七八九十百半")
+
+
+def _bigrams(text):
+    return {text[i : i + 2] for i in range(len(text) - 1)} or {text}
+
+
+class FastPathIndex:
+    """
+    Utterance -> call index built from the training JSONL. Single-turn commands whose call
+    only uses listed enum / boolean values (SearchWlan(), BlueToothOnOff(ActionType=True))
+    are answered from the index without running the model. Near matches are scored by
+    bigram overlap times label consistency, and only answered at or above `threshold`; a
+    near match whose differing characters include an on/off or direction verb or a number
+    is never used, since bigram overlap cannot tell 打开 from 关闭.
+    """
+
+    def __init__(self, entries=None, threshold=FAST_PATH_THRESHOLD, min_support=1):
+        self.entries = entries or {}  # key -> {call: count}
+        self.threshold = threshold
+        self.min_support = min_support
+        self.postings = {}
+        for key in self.entries:
+            for gram in _bigrams(key):
+                self.postings.setdefault(gram, set()).add(key)
+        self.queries = 0
+        self.served = 0
+
+    @staticmethod
+    def make_key(text):
+        text = normalize_utterance(text)
+        for filler in _LEADING_FILLERS:
+            if text.startswith(filler):
+                text = text[len(filler):]
+                break
+        stripped = True
+        while stripped:
+            stripped = False
+            for filler in _TRAILING_FILLERS:
+                if text.endswith(filler) and len(text) > len(filler):
+                    text = text[: -len(filler)]
+                    stripped = True
+        return text
+
+    @staticmethod
+    def is_eligible(call, tool_schema):
+        # one call, every argument a listed enum value or a boolean: nothing is copied from the utterance
+        match = re.fullmatch(r"([A-Z][A-Za-z]*)\((.*)\)", call.strip())
+        if match is None or match.group(1) not in tool_schema or "|" in call:
+            return False
+        params = tool_schema[match.group(1)]
+        for param, value in _CALL_ARGUMENT.findall(match.group(2)):
+            if param not in params:
+                return False
+            param_type, values, _ = params[param]
+            if param_type != "Boo" and value.strip('"') not in values:
+                return False
+        return True
+
+    @classmethod
+    def build(cls, file_paths, tool_schema, **kwargs):
+        entries = {}
+        for file_path in file_paths:
+            if not os.path.exists(file_path):
+                continue
+            with open(file_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        dialogue = json.loads(line)["data"]
+                    except (json.JSONDecodeError, KeyError):
+                        continue
+                    if len(dialogue) != 2 or dialogue[0]["role"] != "user" or dialogue[1]["role"] != "assistant":
+                        continue
+                    call = dialogue[1]["content"].strip()
+                    key = cls.make_key(dialogue[0]["content"])
+                    counts = entries.setdefault(key, {})
+                    # ineligible labels still count, so an ambiguous utterance loses consistency
+                    label = call if cls.is_eligible(call, tool_schema) else None
+                    counts[label] = counts.get(label, 0) + 1
+        return cls(entries, **kwargs)
+
+    def predict(self, input_messages):
+        """(call, confidence) for a single-turn request; call is None when the index has no answer."""
+        if len(input_messages) != 1 or input_messages[0]["role"] != "user":
+            return None, 0.0
+        key = self.make_key(input_messages[0]["content"])
+        similarity = 1.0
+        if key not in self.entries:
+            # nearest indexed utterance by bigram Dice coefficient
+            grams = _bigrams(key)
+            candidates = set().union(*(self.postings.get(gram, ()) for gram in grams))
+            best_key, similarity = None, 0.0
+            for candidate in candidates:
+                differing = set(key) ^ set(candidate)
+                if differing & _CONTRADICTING_CHARS or any(char.isdigit() for char in differing):
+                    continue
+                other = _bigrams(candidate)
+                score = 2 * len(grams & other) / (len(grams) + len(other))
+                if score > similarity:
+                    best_key, similarity = candidate, score
+            if best_key is None:
+                return None, 0.0
+            key = best_key
+        counts = self.entries[key]
+        call, count = max(counts.items(), key=lambda item: item[1])
+        total = sum(counts.values())
+        if call is None or total < self.min_support:
+            return None, 0.0
+        return call, similarity * count / total
+
+    def lookup(self, input_messages):
+        self.queries += 1
+        call, confidence = self.predict(input_messages)
+        if call is None or confidence < self.threshold:
+            return None
+        self.served += 1
+        return call
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"threshold": self.threshold, "min_support": self.min_support, "entries": self.entries},
+                f,
+                ensure_ascii=False,
+            )
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        # JSON object keys are strings; the ineligible label was stored as "null"
+        entries = {
+            key: {None if call == "null" else call: count for call, count in counts.items()}
+            for key, counts in data["entries"].items()
+        }
+        return cls(entries, threshold=data["threshold"], min_support=data["min_support"])
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "queries": self.queries,
+            "served": self.served,
+            "served_share": self.served / self.queries if self.queries else 0.0,
+        }
+
+
+# --- Continuous Batching Scheduler ---
+class _ScheduledSequence:
+    def __init__(self, messages, future, max_new_tokens, adapter):
+        self.messages = messages
+        self.future = future
+        self.max_new_tokens = max_new_tokens
+        self.adapter = adapter
+        self.output_ids = []
+        self.position = 0  # position id of the next token fed to the model
+
+
+class ContinuousBatchScheduler:
+    """
+    Step-level scheduler around BaseLLM. New requests are prefilled on their own and
+    then join the running decode batch; a sequence leaves the batch (and its KV rows are
+    dropped) as soon as it emits </tool> or EOS, instead of waiting for the whole batch.
+    The running batch keeps one left-padded KV cache, with the padding masked out.
+    Each request carries its own token budget and LoRA adapter; rows with different adapters
+    share the batch (peft applies each delta to its own rows). Decoding is plain greedy, without
+    the constrained / speculative paths run() can take.
+    """
+
+    def __init__(self, llm, postprocess, max_batch_size=8, max_new_tokens=1024, stop_string="</tool>"):
+        self.llm = llm
+        self.postprocess = postprocess
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.stop_string = stop_string
+        self.eos_ids = llm.eos_token_ids()
+
+        self.waiting = queue.Queue()
+        self.active = []
+        self.kv = None              # per layer (key, value), shape [batch, heads, seq, head_dim]
+        self.attention_mask = None  # [batch, seq], 0 marks left padding
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, messages, max_new_tokens=None, adapter=None):
+        # adapter: name from LORA_ADAPTERS; None uses the adapter active at submit time
+        if not self._running:
+            raise RuntimeError("ContinuousBatchScheduler has been shut down.")
+        if adapter is not None and adapter not in self.llm.adapter_paths:
+            raise ValueError(f"Unknown LoRA adapter '{adapter}', loaded: {list(self.llm.adapter_paths)}")
+        future = Future()
+        seq = _ScheduledSequence(
+            messages, future, max_new_tokens or self.max_new_tokens, adapter or self.llm.active_adapter
+        )
+        self.waiting.put(seq)
+        return future
+
+    def shutdown(self):
+        self._running = False
+        self._thread.join()
+        # fail everything still running or queued, callers blocked on result() would hang otherwise
+        error = RuntimeError("ContinuousBatchScheduler was shut down before the request finished.")
+        pending = self.active
+        self.active, self.kv, self.attention_mask = [], None, None
+        while True:
+            try:
+                pending.append(self.waiting.get_nowait())
+            except queue.Empty:
+                break
+        for seq in pending:
+            if not seq.future.done():
+                seq.future.set_exception(error)
+
+    def _loop(self):
+        with torch.inference_mode():
+            while self._running:
+                try:
+                    self._admit()
+                    if self.active:
+                        self._decode_step()
+                except Exception as e:
+                    for seq in self.active:
+                        seq.future.set_exception(e)
+                    self.active, self.kv, self.attention_mask = [], None, None
+
+    def _admit(self):
+        while len(self.active) < self.max_batch_size:
+            try:
+                # block only when there is nothing to decode
+                seq = self.waiting.get(timeout=0.05) if not self.active else self.waiting.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self._prefill(seq)
+            except Exception as e:
+                seq.future.set_exception(e)
+
+    def _adapter_kwargs(self, seqs):
+        return {"adapter_names": [seq.adapter for seq in seqs]} if self.llm.adapter_paths else {}
+
+    def _prefill(self, seq):
+        llm = self.llm
+        input_ids = llm.encode_messages(seq.messages)
+        if llm.memory_budget is not None:
+            seq.max_new_tokens = llm.memory_budget.fit(input_ids.shape[1], seq.max_new_tokens)
+        past_key_values = None
+        if llm.use_prefix_cache:
+            past_key_values = llm._lookup_prefix_cache(seq.messages, input_ids, adapter=seq.adapter)
+        if past_key_values is None:
+            past_key_values = DynamicCache()
+        cached_len = past_key_values.get_seq_length()
+        outputs = llm.model(
+            input_ids=input_ids[:, cached_len:],
+            past_key_values=past_key_values,
+            use_cache=True,
+            logits_to_keep=1,
+            **self._adapter_kwargs([seq]),
+        )
+        seq.position = input_ids.shape[1]
+        seq.output_ids.append(int(outputs.logits[0, -1].argmax()))
+        if self._finished(seq):
+            self._complete(seq)
+            return
+        self._join(seq, outputs.past_key_values.to_legacy_cache(), input_ids.shape[1])
+
+    def _join(self, seq, kv, seq_len):
+        mask = torch.ones((1, seq_len), dtype=torch.long, device=self.llm.model.device)
+        if self.kv is None:
+            self.kv, self.attention_mask, self.active = kv, mask, [seq]
+            return
+        batch_len = self.attention_mask.shape[1]
+        target_len = max(batch_len, seq_len)
+        batch_kv = [(_left_pad(k, target_len), _left_pad(v, target_len)) for k, v in self.kv]
+        new_kv = [(_left_pad(k, target_len), _left_pad(v, target_len)) for k, v in kv]
+        self.kv = [
+            (torch.cat([bk, nk], dim=0), torch.cat([bv, nv], dim=0))
+            for (bk, bv), (nk, nv) in zip(batch_kv, new_kv)
+        ]
+        self.attention_mask = torch.cat(
+            [_left_pad(self.attention_mask, target_len), _left_pad(mask, target_len)], dim=0
+        )
+        self.active.append(seq)
+
+    def _decode_step(self):
+        device = self.llm.model.device
+        input_ids = torch.tensor([[seq.output_ids[-1]] for seq in self.active], device=device)
+        position_ids = torch.tensor([[seq.position] for seq in self.active], device=device)
+        attention_mask = torch.cat(
+            [self.attention_mask, torch.ones((len(self.active), 1), dtype=torch.long, device=device)], dim=1
+        )
+        outputs = self.llm.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=DynamicCache.from_legacy_cache(tuple(self.kv)),
+            use_cache=True,
+            **self._adapter_kwargs(self.active),
+        )
+        self.kv = list(outputs.past_key_values.to_legacy_cache())
+        self.attention_mask = attention_mask
+
+        next_tokens = outputs.logits[:, -1].argmax(dim=-1).tolist()
+        keep = []
+        for row, (seq, token) in enumerate(zip(self.active, next_tokens)):
+            seq.position += 1
+            seq.output_ids.append(token)
+            if self._finished(seq):
+                self._complete(seq)
+            else:
+                keep.append(row)
+        if len(keep) < len(self.active):
+            self._evict(keep)
+
+    def _evict(self, keep):
+        if not keep:
+            self.active, self.kv, self.attention_mask = [], None, None
+            return
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        self.active = [self.active[row] for row in keep]
+        self.attention_mask = self.attention_mask.index_select(0, index)
+        # drop leading columns that are padding for every remaining row
+        start = int((self.attention_mask.sum(dim=0) > 0).nonzero()[0])
+        self.attention_mask = self.attention_mask[:, start:]
+        self.kv = [
+            (k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:])
+            for k, v in self.kv
+        ]
+
+    def _finished(self, seq):
+        if seq.output_ids[-1] in self.eos_ids or len(seq.output_ids) >= seq.max_new_tokens:
+            return True
+        tail = self.llm.tokenizer.decode(seq.output_ids[-8:], skip_special_tokens=True)
+        return self.stop_string in tail
+
+    def _complete(self, seq):
+        content = self.llm.tokenizer.decode(seq.output_ids, skip_special_tokens=True)
+        seq.future.set_result(self.postprocess(content))
+
+
+def _left_pad(tensor, target_len):
+    # pads the sequence dimension (dim 2 for KV, dim 1 for masks) on the left with zeros
+    seq_dim = 2 if tensor.dim() == 4 else 1
+    pad_len = target_len - tensor.shape[seq_dim]
+    if pad_len == 0:
+        return tensor
+    pad_shape = list(tensor.shape)
+    pad_shape[seq_dim] = pad_len
+    return torch.cat([tensor.new_zeros(pad_shape), tensor], dim=seq_dim)
+
+
+#较短的提示词
+SYSTEM_PROMPT = """
            # 角色
     你是一个全上下文感知的智能指令执行引擎。你的核心能力是审视完整的对话历史，精准捕捉用户的**最终意图**，并绝对严格从工具列表选择若干函数输出。
 
@@ -185,17 +2427,531 @@ class CustomAgent:
     7.  **时间格式**： 关于输出时间，严格从用户对话中提取时间，例如明天上午八点半，不要自己编造时间。
 
     """
+
+
+class CustomAgent:
+    def __init__(
+        self,
+        constrained_decoding=USE_CONSTRAINED_DECODING,
+        speculative_decoding=USE_SPECULATIVE_DECODING,
+        draft_model_path=DRAFT_MODEL_PATH,
+        tool_retrieval=USE_TOOL_RETRIEVAL,
+        radix_cache=USE_RADIX_CACHE,
+        response_cache_size=RESPONSE_CACHE_SIZE,
+        response_cache_path=RESPONSE_CACHE_PATH,
+        quantization=QUANTIZATION,
+        warmup_runs=WARMUP_RUNS,
+        metrics_sink=None,
+        base_model_path="models/Qwen3-1.7B",
+        lora_weights_path="./lora_weights/",
+        memory_budget_mb=MEMORY_BUDGET_MB,
+        lora_adapters=LORA_ADAPTERS,
+        history_max_tokens=HISTORY_MAX_TOKENS,
+        fast_path_index_path=FAST_PATH_INDEX_PATH,
+        mmap_weights=False,
+    ):
+        print("Initializing CustomAgent...")
+
+        self.llm = BaseLLM(
+            base_model_path,
+            lora_weights_path,
+            radix_cache_max_mb=RADIX_CACHE_MAX_MB if radix_cache else None,
+            quantization=quantization,
+            quantized_model_path=os.path.join(QUANTIZED_MODEL_PATH, quantization) if quantization else None,
+            merged_model_path=MERGED_MODEL_PATH,
+            memory_budget_mb=memory_budget_mb,
+            lora_adapters=lora_adapters,
+            mmap_weights=mmap_weights,
+        )
+        if quantization and not quantized_model_is_current(
+            os.path.join(QUANTIZED_MODEL_PATH, quantization), base_model_path, lora_weights_path, quantization
+        ):
+            self.llm.save_quantized(os.path.join(QUANTIZED_MODEL_PATH, quantization))
+        self.speculative_decoding = speculative_decoding
+        if speculative_decoding and draft_model_path:
+            self.llm.load_draft_model(draft_model_path)
+        self.system_prompt = SYSTEM_PROMPT
+        self.history_max_tokens = history_max_tokens
+        self.fast_path = None
+        if fast_path_index_path and os.path.exists(fast_path_index_path):
+            self.fast_path = FastPathIndex.load(fast_path_index_path)
+            print(f"Fast path index loaded ({len(self.fast_path.entries)} utterances, threshold {self.fast_path.threshold}).")
+        # with tool retrieval most prompts carry a reduced tool list, so a KV cache of the full
+        # prompt would rarely match yet stay reserved in the memory budget; the radix cache still
+        # pays off there since it matches the shared header and learns the retrieved prompts
+        self.prefix_cache_full_prompt = self.llm.use_prefix_cache and (
+            not tool_retrieval or self.llm.radix_cache is not None
+        )
+        if self.prefix_cache_full_prompt:
+            for adapter in self.llm.adapter_paths:
+                self.llm.set_adapter(adapter)
+                self.llm.build_prefix_cache(self.system_prompt)
+            if not self.llm.adapter_paths:
+                self.llm.build_prefix_cache(self.system_prompt)
+        else:
+            self.llm.cache_system_segment(self.system_prompt)
+        if self.llm.memory_budget is not None:
+            # worst case per request: its own copy of the system prefix KV + history + the full decode budget
+            plan = self.llm.memory_budget.plan(len(self.llm.system_segment["input_ids"]) + 1024)
+            print(f"Memory plan: {plan}")
+        self.tool_schema = parse_tool_schema(self.system_prompt)
+        self.signature_tokens = self._longest_signature_tokens()
+        self.tool_retriever = ToolRetriever(self.system_prompt) if tool_retrieval else None
+        self.constrained_decoding = constrained_decoding
+        if constrained_decoding:
+            self.llm.set_tool_grammar(self.tool_schema)
+        self.scheduler = None
+        self.response_cache = None
+        # adapter path -> fingerprint of the files that were actually loaded (see cache_fingerprint)
+        self._adapter_fingerprints = {}
+        for path in list(self.llm.adapter_paths.values()) or [self.llm.lora_weights_path]:
+            if path and os.path.exists(path):
+                self._adapter_fingerprints[path] = _adapter_fingerprint(path)
+        if response_cache_size:
+            self.response_cache = ResponseCache(response_cache_size, response_cache_path)
+            atexit.register(self.response_cache.save)
+        # per-stage latency records go here (HistogramSink / JsonlSink / PrometheusSink); None disables timing
+        self.metrics_sink = metrics_sink
+        if warmup_runs:
+            self.llm.warmup(self.build_messages([{"role": "user", "content": "打开蓝牙"}]), runs=warmup_runs)
         print("CustomAgent initialized successfully with complete system prompt.")
 
+    def run(self, input_messages, adapter=None) -> str:
+        # adapter: name from LORA_ADAPTERS; None keeps the currently active one
+        if adapter is not None:
+            self.llm.set_adapter(adapter)
+        timer = StageTimer(self.llm.model.device) if self.metrics_sink is not None else NULL_TIMER
+        if self._fast_path_applies():
+            call = self.fast_path.lookup(input_messages)
+            timer.lap("fast_path")
+            if call is not None:
+                self._emit_metrics(timer, cache_hit=True)
+                return call
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = ResponseCache.make_key(self.cache_fingerprint(), input_messages)
+            cached = self.response_cache.get(cache_key)
+            timer.lap("response_cache")
+            if cached is not None:
+                self._emit_metrics(timer, cache_hit=True)
+                return cached
+        if self.prefix_cache_full_prompt and not self.llm.has_prefix_cache(self.system_prompt):
+            # system prompt was changed after init, rebuild the cached prefix
+            self.llm.build_prefix_cache(self.system_prompt)
+        if self.llm.memory_budget is not None:
+            input_messages = self._fit_history(input_messages)
+        messages = self.build_messages(input_messages)
+        response_content = self.llm.generate(
+            messages,
+            max_new_tokens=self.estimate_max_new_tokens(input_messages),
+            stop_strings=STOP_STRINGS,
+            do_sample=False,
+            constrained=self.constrained_decoding,
+            speculative=self.speculative_decoding,
+            timer=timer,
+        ) # Use temperature=0.0 for deterministic output
+        tool_call = extract_tool_call(response_content)
+        timer.lap("extract")
+        if cache_key is not None:
+            self.response_cache.put(cache_key, tool_call)
+        self._emit_metrics(timer, cache_hit=False)
+        return tool_call
+
+    def run_stream(self, input_messages, adapter=None):
+        """
+        Same result as run(), but yields each tool call as soon as it is complete, so the
+        device can start on the first action while the rest is still being decoded.
+        Streams through the plain HF decode path (no constrained / speculative decoding).
+        """
+        if adapter is not None:
+            self.llm.set_adapter(adapter)
+        if self._fast_path_applies():
+            call = self.fast_path.lookup(input_messages)
+            if call is not None:
+                yield call
+                return
+        parser = ToolCallStreamParser()
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = ResponseCache.make_key(self.cache_fingerprint(), input_messages)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                # the cached value is run()'s return; only a call list is split into calls
+                if re.match(r"[A-Z]\w*\(", cached.strip()):
+                    yield from parser.feed(f"<tool>{cached}</tool>")
+                else:
+                    yield cached
+                return
+        if self.prefix_cache_full_prompt and not self.llm.has_prefix_cache(self.system_prompt):
+            self.llm.build_prefix_cache(self.system_prompt)
+        if self.llm.memory_budget is not None:
+            input_messages = self._fit_history(input_messages)
+        messages = self.build_messages(input_messages)
+        streamer = TextIteratorStreamer(self.llm.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        errors = []
+
+        def generate():
+            try:
+                self.llm.generate(
+                    messages,
+                    max_new_tokens=self.estimate_max_new_tokens(input_messages),
+                    stop_strings=STOP_STRINGS,
+                    do_sample=False,
+                    streamer=streamer,
+                )
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+        for delta in streamer:
+            yield from parser.feed(delta)
+        thread.join()
+        if errors:
+            raise errors[0]
+        yield from parser.finish()
+        if cache_key is not None:
+            self.response_cache.put(cache_key, extract_tool_call(parser.text))
+
+    def _fast_path_applies(self):
+        # the index answers for the default adapter (first in LORA_ADAPTERS); others go to the model
+        return self.fast_path is not None and self.llm.active_adapter == next(iter(self.llm.adapter_paths), None)
+
+    def _fit_history(self, input_messages):
+        # drop the oldest user/assistant rounds until the prompt leaves room for MIN_NEW_TOKENS;
+        # the kept history always starts at a user turn, and the last user turn is always kept
+        max_context_len = self.llm.memory_budget.max_context_len
+        round_starts = [i for i, message in enumerate(input_messages) if message["role"] == "user" and i > 0]
+        for start in [0] + round_starts[:-1]:
+            messages = input_messages[start:]
+            prompt_tokens = self.llm.encode_messages(self.build_messages(messages)).shape[1]
+            if prompt_tokens + MIN_NEW_TOKENS <= max_context_len:
+                return messages
+        return input_messages[round_starts[-1]:] if round_starts else input_messages
+
+    def _emit_metrics(self, timer, cache_hit):
+        if timer.enabled:
+            timer.set(cache_hit=cache_hit)
+            self.metrics_sink.emit(timer.record())
+
+    def cache_fingerprint(self):
+        # everything besides the messages that can change the output; the cache may be persisted
+        # (RESPONSE_CACHE_PATH), so the adapter is identified by its files, not only by its path
+        lora_weights_path = self.llm.lora_weights_path
+        return [
+            self.llm.model_path,
+            lora_weights_path,
+            self._adapter_fingerprints.get(lora_weights_path),
+            self.llm.quantization,
+            hashlib.sha256(self.system_prompt.encode("utf-8")).hexdigest(),
+            self.constrained_decoding,
+            self.tool_retriever is not None,
+            # history compaction and budget trimming change the prompt the model sees
+            self.history_max_tokens,
+            HISTORY_KEEP_ROUNDS,
+            self.llm.memory_budget.max_context_len if self.llm.memory_budget is not None else None,
+        ]
+
+    def build_messages(self, input_messages):
+        input_messages = compact_history(input_messages, self.llm.tokenizer, self.history_max_tokens)
+        system_prompt = self.system_prompt
+        if self.tool_retriever is not None:
+            # reduced prompt with the top-k candidate tools (full list when retrieval is unsure)
+            system_prompt = self.tool_retriever.build_prompt(input_messages)
+        return [{"role": "system", "content": system_prompt}] + input_messages
+
+    def _longest_signature_tokens(self):
+        # token length of the longest call the schema allows, with every parameter set to ""
+        longest = 0
+        for name, params in self.tool_schema.items():
+            signature = f"{name}(" + ", ".join(f'{param}=""' for param in params) + ")|"
+            longest = max(longest, len(self.llm.tokenizer.encode(signature, add_special_tokens=False)))
+        return longest
+
+    def estimate_max_new_tokens(self, input_messages, upper_bound=1024):
+        # Intents still pending are those stated after the last executed call. Each clause
+        # of those user turns can become at most one call; argument values are copied from
+        # the utterance, so its token count bounds the value text.
+        pending = []
+        for message in input_messages:
+            if message["role"] == "assistant" and re.match(r"^\s*(<tool>)?\s*[A-Z]\w*\(", message["content"]):
+                pending = []
+            elif message["role"] == "user":
+                pending.append(message["content"])
+        utterance = "\n".join(pending)
+        clauses = [c for c in re.split(_CLAUSE_SPLIT, utterance) if c.strip()]
+        utterance_tokens = len(self.llm.tokenizer.encode(utterance, add_special_tokens=False))
+        budget = 8 + max(len(clauses), 1) * self.signature_tokens + utterance_tokens
+        return min(max(budget, MIN_NEW_TOKENS), upper_bound)
+
+    def run_batch(self, list_of_messages, batch_size=16, adapters=None) -> list:
+        # adapters: one adapter name per request (mixed batches allowed), None uses the active adapter
+        if self.llm.memory_budget is not None:
+            batch_size = min(batch_size, self.llm.memory_budget.max_batch_size)
+        results = []
+        for start in range(0, len(list_of_messages), batch_size):
+            chunk = list_of_messages[start : start + batch_size]
+            messages_list = [
+                self.build_messages(input_messages)
+                for input_messages in chunk
+            ]
+            responses = self.llm.generate_batch(
+                messages_list,
+                do_sample=False,
+                constrained=self.constrained_decoding,
+                adapters=adapters[start : start + batch_size] if adapters is not None else None,
+            )
+            results.extend(extract_tool_call(response_content) for response_content in responses)
+        return results
+
+    def start_scheduler(self, max_batch_size=8):
+        if self.llm.memory_budget is not None:
+            max_batch_size = min(max_batch_size, self.llm.memory_budget.max_batch_size)
+        if self.scheduler is None:
+            self.scheduler = ContinuousBatchScheduler(
+                self.llm, postprocess=extract_tool_call, max_batch_size=max_batch_size
+            )
+        return self.scheduler
+
+    def submit(self, input_messages, adapter=None) -> Future:
+        # Future resolves to the same string run() returns with greedy, unconstrained decoding
+        if self.llm.memory_budget is not None:
+            input_messages = self._fit_history(input_messages)
+        messages = self.build_messages(input_messages)
+        return self.start_scheduler().submit(
+            messages, max_new_tokens=self.estimate_max_new_tokens(input_messages), adapter=adapter
+        )
+
+    async def run_async(self, input_messages, adapter=None) -> str:
+        return await asyncio.wrap_future(self.submit(input_messages, adapter=adapter))
+
+
+
+# --- Multi-Process CPU Worker Pool ---
+def _proc_pss_mb(pid):
+    # proportional set size: shared (mmap'd) pages are split between the processes mapping them
+    with open(f"/proc/{pid}/smaps_rollup", "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("Pss:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+WORKER_START_TIMEOUT_S = 600  # loading the merged artifact; a worker that takes longer is treated as failed
+WORKER_POLL_S = 1.0  # how often the pool checks that its workers are still alive
+
+
+def _agent_worker(cores, num_threads, agent_kwargs, requests, results):
+    # `requests` is this worker's own queue; messages to the parent: (kind, pid, request_id, payload)
+    pid = os.getpid()
+    try:
+        if cores:
+            os.sched_setaffinity(0, cores)
+        torch.set_num_threads(num_threads)
+        agent = CustomAgent(mmap_weights=True, **agent_kwargs)
+    except Exception as e:
+        results.put(("init_error", pid, None, f"{type(e).__name__}: {e}"))
+        return
+    results.put(("ready", pid, None, None))
+    with torch.inference_mode():
+        while True:
+            item = requests.get()
+            if item is None:
+                break
+            request_id, input_messages = item
+            try:
+                results.put(("result", pid, request_id, agent.run(input_messages)))
+            except Exception as e:
+                results.put(("error", pid, request_id, f"{type(e).__name__}: {e}"))
+
+
+class AgentWorkerPool:
+    """
+    N CustomAgent processes on one CPU host, each pinned to its own cores with its own thread
+    count. Workers load the merged artifact (utils/export_merged_model.py) through
+    mmap_safetensors, so the weights are in memory once no matter how many workers run.
+    The parent hands each request to an idle worker through that worker's own queue, so it
+    always knows which request a worker holds.
+
+    mmap_weights is always on and cannot be passed; quantization is rejected because the
+    quantized artifact is loaded privately by every worker, so nothing would be shared.
+    A worker that fails to start makes the constructor raise; one that dies later fails the
+    request it was serving, and once no worker is left every pending request fails.
+    """
+
+    def __init__(self, num_workers, core_groups=None, **agent_kwargs):
+        if "mmap_weights" in agent_kwargs:
+            raise ValueError("AgentWorkerPool always maps the merged weights; do not pass mmap_weights.")
+        if agent_kwargs.get("quantization"):
+            raise ValueError("AgentWorkerPool shares the bf16 merged weights; quantized models are not supported.")
+        if not merged_model_is_current(
+            MERGED_MODEL_PATH,
+            agent_kwargs.get("base_model_path", "models/Qwen3-1.7B"),
+            agent_kwargs.get("lora_weights_path", "./lora_weights/"),
+        ):
+            raise ValueError(f"No current merged model at {MERGED_MODEL_PATH}; run utils/export_merged_model.py first.")
+        if core_groups is None:
+            # split the cores this process may use into contiguous groups, one per worker
+            cores = sorted(os.sched_getaffinity(0))
+            size = max(len(cores) // num_workers, 1)
+            core_groups = [cores[i * size : (i + 1) * size] or cores for i in range(num_workers)]
+        context = multiprocessing.get_context("spawn")
+        self.requests = [context.Queue() for _ in core_groups]
+        self.results = context.Queue()
+        self.workers = [
+            context.Process(
+                target=_agent_worker,
+                args=(group, len(group), agent_kwargs, requests, self.results),
+                daemon=True,
+            )
+            for group, requests in zip(core_groups, self.requests)
+        ]
+        for worker in self.workers:
+            worker.start()
+        try:
+            self._wait_ready()
+        except Exception:
+            self._terminate()
+            raise
+        self.pids = [worker.pid for worker in self.workers]
+        self.futures = {}
+        self.pending = []  # request ids not yet handed to a worker, oldest first
+        # request id each worker is serving, recorded before the request is sent to it
+        self.assigned = [None] * len(self.workers)
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+        print(f"AgentWorkerPool ready: {len(self.workers)} workers, cores {core_groups}")
+
+    def _wait_ready(self):
+        ready = set()
+        deadline = time.monotonic() + WORKER_START_TIMEOUT_S
+        while len(ready) < len(self.workers):
+            try:
+                kind, pid, _, error = self.results.get(timeout=WORKER_POLL_S)
+            except queue.Empty:
+                dead = [worker.pid for worker in self.workers if not worker.is_alive() and worker.pid not in ready]
+                if dead:
+                    raise RuntimeError(f"Agent workers {dead} exited while loading the model.")
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Agent workers not ready after {WORKER_START_TIMEOUT_S}s.")
+                continue
+            if kind == "init_error":
+                raise RuntimeError(f"Agent worker {pid} failed to start: {error}")
+            ready.add(pid)
+
+    def _terminate(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+    def submit(self, input_messages) -> Future:
+        future = Future()
+        with self.lock:
+            if not any(worker.is_alive() for worker in self.workers):
+                raise RuntimeError("All agent workers have exited.")
+            request_id = self.next_id
+            self.next_id += 1
+            self.futures[request_id] = (future, input_messages)
+            self.pending.append(request_id)
+            self._dispatch()
+        return future
+
+    def _dispatch(self):
+        # called with self.lock held
+        for index, worker in enumerate(self.workers):
+            if not self.pending:
+                return
+            if self.assigned[index] is None and worker.is_alive():
+                request_id = self.pending.pop(0)
+                self.assigned[index] = request_id
+                self.requests[index].put((request_id, self.futures[request_id][1]))
+
     def run(self, input_messages) -> str:
-        messages = [{"role": "system", "content": self.system_prompt}] + input_messages
-        response_content = self.llm.generate(messages, do_sample=False) # Use temperature=0.0 for deterministic output
-        tool_calls = re.findall(r"<tool>(.*?)</tool>", response_content, re.DOTALL)
-        if tool_calls:
-            tool_call = tool_calls[-1].strip()
-            if "(" not in tool_call and ")" not in tool_call:
-                tool_call += "()"
-            return tool_call
+        return self.submit(input_messages).result()
+
+    def map(self, list_of_messages) -> list:
+        futures = [self.submit(input_messages) for input_messages in list_of_messages]
+        return [future.result() for future in futures]
+
+    def _collect(self):
+        last_check = time.monotonic()
+        while True:
+            if time.monotonic() - last_check >= WORKER_POLL_S:
+                self._check_workers()
+                last_check = time.monotonic()
+            try:
+                message = self.results.get(timeout=WORKER_POLL_S)
+            except queue.Empty:
+                continue
+            if message[0] == "stop":
+                break
+            self._handle(message)
+
+    def _handle(self, message):
+        kind, pid, request_id, payload = message
+        with self.lock:
+            index = self.pids.index(pid)
+            if self.assigned[index] == request_id:
+                self.assigned[index] = None
+            # None if the request was already failed because its worker looked dead
+            entry = self.futures.pop(request_id, None)
+            self._dispatch()
+        if entry is None:
+            return
+        if kind == "error":
+            entry[0].set_exception(RuntimeError(payload))
         else:
-            return response_content.strip()
+            entry[0].set_result(payload)
+
+    def _check_workers(self):
+        dead = [index for index, worker in enumerate(self.workers) if not worker.is_alive()]
+        if not dead:
+            return
+        # a worker may have sent its result just before exiting; take those before failing anything
+        while True:
+            try:
+                message = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == "stop":
+                self.results.put(message)
+                break
+            self._handle(message)
+        with self.lock:
+            failed = []
+            for index in dead:
+                request_id = self.assigned[index]
+                if request_id is None:
+                    continue
+                # died in the middle of a request (OOM kill, segfault)
+                self.assigned[index] = None
+                future, _ = self.futures.pop(request_id)
+                worker = self.workers[index]
+                failed.append((future, f"Agent worker {worker.pid} exited (code {worker.exitcode})."))
+            if len(dead) == len(self.workers):
+                failed += [(future, "All agent workers have exited.") for future, _ in self.futures.values()]
+                self.futures.clear()
+                self.pending.clear()
+        for future, message in failed:
+            future.set_exception(RuntimeError(message))
+
+    def memory_usage(self):
+        """Per-worker PSS in MB; the sum is the real memory footprint of the pool."""
+        return {pid: _proc_pss_mb(pid) for pid in self.pids}
 
+    def close(self):
+        # queued requests are still served; a worker that dies meanwhile fails its own (see _check_workers)
+        with self.lock:
+            futures = [future for future, _ in self.futures.values()]
+        wait(futures)
+        for worker, requests in zip(self.workers, self.requests):
+            if worker.is_alive():
+                requests.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.results.put(("stop", None, None, None))
+        self.collector.join()
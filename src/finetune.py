@@ -2,14 +2,16 @@ import json
 import torch
 import  os
 import re
-from datasets import load_dataset, Dataset
+import shutil
+from datasets import load_dataset, Dataset, load_from_disk
 from peft import LoraConfig, get_peft_model
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     TrainingArguments,
-    Trainer,
-    DataCollatorForSeq2Seq
+)
+from train_utils import (
+    PackedDataset, LoraTrainer, dataset_cache_key, make_data_collator, make_format_prompt,
 )
 
 
@@ -31,6 +33,19 @@ TRAIN_DATA_FILES = [
     "data/final_data/高质量多轮多.jsonl",
 ]
 OUTPUT_DIR = "./lora_weights"
+# 分词后的数据集缓存 (Arrow, 读取时内存映射); 目录名是输入内容的哈希, 输入不变就直接复用
+DATASET_CACHE_DIR = "./cache/tokenized_dataset"
+NUM_PROC = min(8, os.cpu_count() or 1)  # 数据预处理的进程数
+# 序列打包: 多条样本拼进一行 (不超过 MAX_SEQ_LENGTH), 注意力不跨样本; False 为逐条 padding。
+# 打包后每步的样本数变多、总步数变少, 开启时需相应调小 GRADIENT_ACCUMULATION_STEPS / 学习率 (先用 bench_training.py 对比)
+PACKING = False
+# 共享前缀训练: 系统提示词每个 microbatch 只前向一次, KV 广播给 batch 内所有样本 (BATCH_SIZE 越大越划算);
+# 与 PACKING、梯度检查点互斥
+SHARED_PREFIX_TRAINING = False
+# 只在有监督的位置 (labels != -100) 上算 lm_head, 交叉熵按 TARGET_LOSS_CHUNK 个位置分块, 不再为整段 prompt 生成全词表 logits
+# 默认关闭, 先用 utils/bench_training.py --check-parity 确认 loss 一致再开启
+TARGET_ONLY_LOGITS = False
+TARGET_LOSS_CHUNK = 256
 
 EPOCHS = 5
 BATCH_SIZE = 1
@@ -177,6 +192,13 @@ def create_system_prompt():
 
 # --- 3. 数据预处理 (修改版：兼容不同Schema) ---
 def process_dataset(tokenizer, system_prompt):
+    cache_path = os.path.join(
+        DATASET_CACHE_DIR, dataset_cache_key(tokenizer, system_prompt, TRAIN_DATA_FILES, MAX_SEQ_LENGTH)
+    )
+    if os.path.exists(cache_path):
+        print(f">>> 使用已缓存的分词数据集: {cache_path} <<<")
+        return load_from_disk(cache_path)
+
     
     # --- 核心修改：自定义数据加载器 ---
     # 不直接使用 load_dataset("json")，而是手动读取文件，只提取 'data' 字段
@@ -212,53 +234,34 @@ def process_dataset(tokenizer, system_prompt):
 
     dataset = dataset.shuffle(seed=711) 
     print(">>> 数据集已执行全局打乱 (Global Shuffle Applied) <<<")
-    # --- 格式化逻辑 (保持不变) ---
-    def format_prompt(example):
-        # 处理多轮对话历史
-        dialogue_history = example['data']
-        # 最后一轮是assistant的回答，是我们的目标(label)
-        target = dialogue_history.pop()
-        
-        # 将历史对话格式化
-        messages = [{"role": "system", "content": system_prompt}]
-        for turn in dialogue_history:
-             messages.append({"role": turn['role'], "content": turn['content']})
-
-        # 使用apply_chat_template来构建完整的输入
-        full_prompt_text = tokenizer.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True
-        )
-        
-        # 将目标(assistant的回答)也加上，并加上EOS token
-        final_text = full_prompt_text + f"<tool>{target['content']}</tool>" + tokenizer.eos_token
-        
-        # Tokenize
-        tokenized = tokenizer(final_text, truncation=True, max_length=MAX_SEQ_LENGTH, padding=False)
-        
-        # 计算label，将输入部分的loss屏蔽（设为-100）
-        input_ids_len = len(tokenizer(full_prompt_text, truncation=True, max_length=MAX_SEQ_LENGTH)["input_ids"])
-        labels = tokenized['input_ids'][:]
-        labels[:input_ids_len] = [-100] * input_ids_len
-        
-        return {
-            "input_ids": tokenized['input_ids'],
-            "attention_mask": tokenized['attention_mask'],
-            "labels": labels
-        }
 
     # 格式化所有样本
     # 注意：现在的 dataset 只有 'data' 这一列，所以 remove_columns=["data"]
-    dataset = dataset.map(format_prompt, remove_columns=["data"])
-    return dataset
+    dataset = dataset.map(
+        make_format_prompt(tokenizer, system_prompt, MAX_SEQ_LENGTH), remove_columns=["data"], num_proc=NUM_PROC
+    )
+
+    # 先写临时目录再改名, 中途被打断也不会留下半个缓存
+    tmp_path = f"{cache_path}.tmp{os.getpid()}"
+    dataset.save_to_disk(tmp_path)
+    try:
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # 其他节点/进程已经写好了同一份缓存 (目录名即输入内容的哈希), 直接用它
+        if not os.path.exists(cache_path):
+            raise
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    print(f">>> 分词数据集已缓存到 {cache_path} <<<")
+    return load_from_disk(cache_path)
 
 
 # --- 4. 主训练逻辑  ---
 def main():
+    if SHARED_PREFIX_TRAINING and PACKING:
+        raise ValueError("SHARED_PREFIX_TRAINING 与 PACKING 不能同时开启: 打包后一行里有多份系统提示词")
     print("--- Starting Fine-tuning Process (Half-Precision Mode) ---")
     
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True, use_fast=False)
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True, use_fast=True)
     tokenizer.pad_token = tokenizer.eos_token
 
     model = AutoModelForCausalLM.from_pretrained(
@@ -280,7 +283,6 @@ def main():
     model.print_trainable_parameters()
 
     system_prompt = create_system_prompt()
-    train_dataset = process_dataset(tokenizer, system_prompt)
 
     training_args = TrainingArguments(
         output_dir=OUTPUT_DIR,
@@ -301,13 +303,24 @@ def main():
         # ddp_find_unused_parameters=False,
     )
 
-    trainer = Trainer(
+    # 只有主进程构建缓存, 其余 rank 在 barrier 处等待, 之后直接内存映射同一份缓存
+    with training_args.main_process_first(desc="tokenized dataset cache"):
+        train_dataset = process_dataset(tokenizer, system_prompt)
+    if PACKING:
+        train_dataset = PackedDataset(train_dataset, MAX_SEQ_LENGTH)
+
+    trainer = LoraTrainer(
         model=model,
         args=training_args,
         train_dataset=train_dataset,
         tokenizer=tokenizer,
         # processing_class=tokenizer,
-        data_collator=DataCollatorForSeq2Seq(tokenizer, pad_to_multiple_of=8),
+        data_collator=make_data_collator(
+            model, tokenizer, system_prompt, packing=PACKING, shared_prefix=SHARED_PREFIX_TRAINING
+        ),
+        shared_prefix=SHARED_PREFIX_TRAINING,
+        target_only_logits=TARGET_ONLY_LOGITS,
+        loss_chunk=TARGET_LOSS_CHUNK,
     )
 
     print("--- Starting Training ---")
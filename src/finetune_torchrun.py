@@ -2,14 +2,16 @@ import json
 import torch
 import  os
 import re
-from datasets import load_dataset, Dataset
+import shutil
+from datasets import load_dataset, Dataset, load_from_disk
 from peft import LoraConfig, get_peft_model
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     TrainingArguments,
-    Trainer,
-    DataCollatorForSeq2Seq
+)
+from train_utils import (
+    PackedDataset, LoraTrainer, dataset_cache_key, make_data_collator, make_format_prompt,
 )
 
 
@@ -30,6 +32,19 @@ TRAIN_DATA_FILES = [
     "data/final_data/高质量多轮多.jsonl",
 ]
 OUTPUT_DIR = "./lora_weights"
+# 分词后的数据集缓存 (Arrow, 读取时内存映射); 目录名是输入内容的哈希, 输入不变就直接复用
+DATASET_CACHE_DIR = "./cache/tokenized_dataset"
+NUM_PROC = min(8, os.cpu_count() or 1)  # 数据预处理的进程数
+# 序列打包: 多条样本拼进一行 (不超过 MAX_SEQ_LENGTH), 注意力不跨样本; False 为逐条 padding。
+# 打包后每步的样本数变多、总步数变少, 开启时需相应调小 GRADIENT_ACCUMULATION_STEPS / 学习率 (先用 bench_training.py 对比)
+PACKING = False
+# 共享前缀训练: 系统提示词每个 microbatch 只前向一次, KV 广播给 batch 内所有样本 (BATCH_SIZE 越大越划算);
+# 与 PACKING、梯度检查点互斥
+SHARED_PREFIX_TRAINING = False
+# 只在有监督的位置 (labels != -100) 上算 lm_head, 交叉熵按 TARGET_LOSS_CHUNK 个位置分块, 不再为整段 prompt 生成全词表 logits
+# 默认关闭, 先用 utils/bench_training.py --check-parity 确认 loss 一致再开启
+TARGET_ONLY_LOGITS = False
+TARGET_LOSS_CHUNK = 256
 
 EPOCHS = 5
 BATCH_SIZE = 1
@@ -175,6 +190,13 @@ def create_system_prompt():
 
 # --- 3. 数据预处理 ---
 def process_dataset(tokenizer, system_prompt):
+    cache_path = os.path.join(
+        DATASET_CACHE_DIR, dataset_cache_key(tokenizer, system_prompt, TRAIN_DATA_FILES, MAX_SEQ_LENGTH)
+    )
+    if os.path.exists(cache_path):
+        print(f">>> 使用已缓存的分词数据集: {cache_path} <<<")
+        return load_from_disk(cache_path)
+
     def dataset_generator():
         for file_path in TRAIN_DATA_FILES:
             print(f"Loading data from: {file_path}")
@@ -202,41 +224,31 @@ def process_dataset(tokenizer, system_prompt):
     dataset = dataset.shuffle(seed=711) 
     print(">>> 数据集已执行全局打乱 (Global Shuffle Applied) <<<")
 
-    def format_prompt(example):
-        dialogue_history = example['data']
-        target = dialogue_history.pop()
-        messages = [{"role": "system", "content": system_prompt}]
-        for turn in dialogue_history:
-             messages.append({"role": turn['role'], "content": turn['content']})
-
-        full_prompt_text = tokenizer.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True
-        )
-        
-        final_text = full_prompt_text + f"<tool>{target['content']}</tool>" + tokenizer.eos_token
-        
-        tokenized = tokenizer(final_text, truncation=True, max_length=MAX_SEQ_LENGTH, padding=False)
-        input_ids_len = len(tokenizer(full_prompt_text, truncation=True, max_length=MAX_SEQ_LENGTH)["input_ids"])
-        labels = tokenized['input_ids'][:]
-        labels[:input_ids_len] = [-100] * input_ids_len
-        
-        return {
-            "input_ids": tokenized['input_ids'],
-            "attention_mask": tokenized['attention_mask'],
-            "labels": labels
-        }
+    dataset = dataset.map(
+        make_format_prompt(tokenizer, system_prompt, MAX_SEQ_LENGTH), remove_columns=["data"], num_proc=NUM_PROC
+    )
 
-    dataset = dataset.map(format_prompt, remove_columns=["data"])
-    return dataset
+    # 先写临时目录再改名, 中途被打断也不会留下半个缓存
+    tmp_path = f"{cache_path}.tmp{os.getpid()}"
+    dataset.save_to_disk(tmp_path)
+    try:
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # 其他节点/进程已经写好了同一份缓存 (目录名即输入内容的哈希), 直接用它
+        if not os.path.exists(cache_path):
+            raise
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    print(f">>> 分词数据集已缓存到 {cache_path} <<<")
+    return load_from_disk(cache_path)
 
 
 # --- 4. 主训练逻辑  ---
 def main():
+    if SHARED_PREFIX_TRAINING and PACKING:
+        raise ValueError("SHARED_PREFIX_TRAINING 与 PACKING 不能同时开启: 打包后一行里有多份系统提示词")
     print("--- Starting Fine-tuning Process (No Flash Attention Mode) ---")
     
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True, use_fast=False)
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True, use_fast=True)
     tokenizer.pad_token = tokenizer.eos_token
 
     # 1. 加载模型 (不使用 Flash Attention)
@@ -249,9 +261,11 @@ def main():
     )
 
     # 2. 【关键】手动开启梯度检查点 (解决 6000 长度显存爆炸问题)
-    print("Enabling Gradient Checkpointing manually...")
-    model.gradient_checkpointing_enable()
-    model.enable_input_require_grads()
+    #    共享前缀训练需要前缀的 KV cache, 与梯度检查点互斥, 此时不开启
+    if not SHARED_PREFIX_TRAINING:
+        print("Enabling Gradient Checkpointing manually...")
+        model.gradient_checkpointing_enable()
+        model.enable_input_require_grads()
     model.config.use_cache = False # 训练时必须关闭缓存
 
     lora_config = LoraConfig(
@@ -266,7 +280,6 @@ def main():
     model.print_trainable_parameters()
 
     system_prompt = create_system_prompt()
-    train_dataset = process_dataset(tokenizer, system_prompt)
 
     training_args = TrainingArguments(
         output_dir=OUTPUT_DIR,
@@ -286,16 +299,27 @@ def main():
         ddp_find_unused_parameters=False,
         
         # TrainingArgs 中也设置一下，双重保险
-        gradient_checkpointing=True,
+        gradient_checkpointing=not SHARED_PREFIX_TRAINING,
         gradient_checkpointing_kwargs={"use_reentrant": False},
     )
 
-    trainer = Trainer(
+    # 只有主进程构建缓存, 其余 rank 在 barrier 处等待, 之后直接内存映射同一份缓存
+    with training_args.main_process_first(desc="tokenized dataset cache"):
+        train_dataset = process_dataset(tokenizer, system_prompt)
+    if PACKING:
+        train_dataset = PackedDataset(train_dataset, MAX_SEQ_LENGTH)
+
+    trainer = LoraTrainer(
         model=model,
         args=training_args,
         train_dataset=train_dataset,
         processing_class=tokenizer,
-        data_collator=DataCollatorForSeq2Seq(tokenizer, pad_to_multiple_of=8),
+        data_collator=make_data_collator(
+            model, tokenizer, system_prompt, packing=PACKING, shared_prefix=SHARED_PREFIX_TRAINING
+        ),
+        shared_prefix=SHARED_PREFIX_TRAINING,
+        target_only_logits=TARGET_ONLY_LOGITS,
+        loss_chunk=TARGET_LOSS_CHUNK,
     )
 
     print("--- Starting Training ---")
@@ -0,0 +1,285 @@
+import os
+import json
+import bisect
+import hashlib
+import torch
+import torch.nn.functional as F
+from transformers import Trainer, DataCollatorForSeq2Seq, DynamicCache
+# 与推理共用同一个历史压缩逻辑，保证训练/推理看到的对话分布一致
+from agent import compact_history, HISTORY_MAX_TOKENS, HISTORY_KEEP_ROUNDS
+
+# finetune.py 与 finetune_torchrun.py 共用的数据处理与训练辅助函数;
+# 两个脚本各自的配置 (MAX_SEQ_LENGTH、TRAIN_DATA_FILES、各训练开关) 以参数传入
+DATASET_FORMAT_VERSION = 1  # 修改 format_prompt 的输出格式时 +1, 让旧缓存失效
+TARGET_LOSS_CHUNK = 256  # target_logits_loss 每块计算交叉熵的位置数
+
+
+def system_prompt_ids(tokenizer, system_prompt):
+    """模板化后的系统提示词段的 token, 每条训练样本都以它开头"""
+    system_text = tokenizer.apply_chat_template(
+        [{"role": "system", "content": system_prompt}], tokenize=False, add_generation_prompt=False
+    )
+    return tokenizer(system_text)["input_ids"]
+
+
+def make_format_prompt(tokenizer, system_prompt, max_seq_length):
+    """
+    返回单条样本的格式化函数。系统提示词段只在这里分词一次; 每条样本只对
+    系统段之后的消息和目标分词一次, label 边界由 offset mapping 得到 (需要 fast tokenizer)。
+    """
+    # 空系统提示词的同一模板, 其后的内容即为每条样本自己的部分
+    stub = tokenizer.apply_chat_template(
+        [{"role": "system", "content": ""}], tokenize=False, add_generation_prompt=False
+    )
+    system_ids = system_prompt_ids(tokenizer, system_prompt)
+
+    def format_prompt(example):
+        dialogue_history = example['data']
+        # 最后一轮是assistant的回答，是我们的目标(label)
+        target = dialogue_history.pop()
+        dialogue_history = compact_history(dialogue_history, tokenizer, HISTORY_MAX_TOKENS)
+        messages = [{"role": "system", "content": ""}]
+        for turn in dialogue_history:
+            messages.append({"role": turn['role'], "content": turn['content']})
+        prompt_text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)[len(stub):]
+
+        # 样本部分 = 历史消息 + <tool>目标</tool> + EOS, 只分词这一次
+        sample_text = prompt_text + f"<tool>{target['content']}</tool>" + tokenizer.eos_token
+        tokenized = tokenizer(sample_text, add_special_tokens=False, return_offsets_mapping=True)
+        # 起点落在 prompt 内的 token 都属于输入部分, loss 屏蔽 (设为-100)
+        prompt_tokens = sum(1 for start, _ in tokenized['offset_mapping'] if start < len(prompt_text))
+
+        input_ids = (system_ids + tokenized['input_ids'])[:max_seq_length]
+        input_ids_len = min(len(system_ids) + prompt_tokens, max_seq_length)
+        labels = input_ids[:]
+        labels[:input_ids_len] = [-100] * input_ids_len
+        return {
+            "input_ids": input_ids,
+            "attention_mask": [1] * len(input_ids),
+            "labels": labels
+        }
+
+    return format_prompt
+
+
+def dataset_cache_key(tokenizer, system_prompt, data_files, max_seq_length):
+    """训练文件内容 + 分词器 + 系统提示词 + 截断长度 等所有影响分词结果的输入的哈希"""
+    digest = hashlib.sha256()
+    for file_path in data_files:
+        digest.update(file_path.encode('utf-8'))
+        if os.path.exists(file_path):
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+    vocab = sorted(tokenizer.get_vocab().items())
+    digest.update(json.dumps(
+        [type(tokenizer).__name__, vocab, tokenizer.chat_template, tokenizer.eos_token], ensure_ascii=False
+    ).encode('utf-8'))
+    digest.update(system_prompt.encode('utf-8'))
+    digest.update(json.dumps([max_seq_length, HISTORY_MAX_TOKENS, HISTORY_KEEP_ROUNDS, DATASET_FORMAT_VERSION]).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+class PackedDataset(torch.utils.data.Dataset):
+    """
+    把分词后的样本装箱 (best-fit decreasing), 每个箱子总长不超过 max_length, 作为一条训练行。
+    position_ids 在每个样本开头归零, collator 据此切分样本边界; labels 原样拼接, 保留 -100 屏蔽。
+    """
+
+    def __init__(self, dataset, max_length):
+        self.dataset = dataset
+        lengths = dataset.map(
+            lambda batch: {"length": [len(ids) for ids in batch["input_ids"]]},
+            batched=True, remove_columns=dataset.column_names,
+        )["length"]
+        self.bins = []
+        free = []  # (剩余容量, 箱子编号), 按剩余容量升序
+        for index in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+            pos = bisect.bisect_left(free, (lengths[index], -1))
+            if pos == len(free):
+                self.bins.append([index])
+                bisect.insort(free, (max_length - lengths[index], len(self.bins) - 1))
+            else:
+                room, bin_id = free.pop(pos)
+                self.bins[bin_id].append(index)
+                bisect.insort(free, (room - lengths[index], bin_id))
+        self.num_tokens = sum(lengths)
+        print(f">>> 序列打包: {len(lengths)} 条样本 -> {len(self.bins)} 行, "
+              f"填充率 {self.num_tokens / max(len(self.bins) * max_length, 1):.1%} <<<")
+
+    def __len__(self):
+        return len(self.bins)
+
+    def __getitem__(self, index):
+        samples = self.dataset[self.bins[index]]
+        input_ids, labels, position_ids = [], [], []
+        for sample_ids, sample_labels in zip(samples["input_ids"], samples["labels"]):
+            input_ids += sample_ids
+            labels += sample_labels
+            position_ids += range(len(sample_ids))
+        return {"input_ids": input_ids, "labels": labels, "position_ids": position_ids}
+
+
+class PackedDataCollator:
+    """
+    flatten=True (flash_attention_2): 整个 batch 拼成一行且不传 attention_mask,
+    模型走 varlen 路径, 按 position_ids 归零处切分样本, 注意力不跨样本。
+    flatten=False (sdpa / eager): 按最长行 padding, 生成块对角的 4D 因果 mask (已取反的加性形式)。
+    """
+
+    def __init__(self, pad_token_id, flatten=False, dtype=torch.bfloat16, pad_to_multiple_of=8):
+        self.pad_token_id = pad_token_id
+        self.flatten = flatten
+        self.dtype = dtype
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, features):
+        if self.flatten:
+            return {
+                key: torch.tensor([[value for feature in features for value in feature[key]]])
+                for key in ("input_ids", "labels", "position_ids")
+            }
+
+        length = max(len(feature["input_ids"]) for feature in features)
+        length = -(-length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        batch_size = len(features)
+        input_ids = torch.full((batch_size, length), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((batch_size, length), -100, dtype=torch.long)
+        position_ids = torch.zeros((batch_size, length), dtype=torch.long)
+        attention_mask = torch.full((batch_size, 1, length, length), torch.finfo(self.dtype).min, dtype=self.dtype)
+        for row, feature in enumerate(features):
+            n = len(feature["input_ids"])
+            input_ids[row, :n] = torch.tensor(feature["input_ids"])
+            labels[row, :n] = torch.tensor(feature["labels"])
+            position_ids[row, :n] = torch.tensor(feature["position_ids"])
+            starts = [i for i, pos in enumerate(feature["position_ids"]) if pos == 0] + [n]
+            for start, end in zip(starts, starts[1:]):
+                causal = torch.ones((end - start, end - start), dtype=torch.bool).tril()
+                attention_mask[row, 0, start:end, start:end].masked_fill_(causal, 0)
+            # padding 位置只看自己, 避免整行被屏蔽后 softmax 出现 NaN
+            pad = torch.arange(n, length)
+            attention_mask[row, 0, pad, pad] = 0
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "position_ids": position_ids,
+            "attention_mask": attention_mask,
+        }
+
+
+class SharedPrefixCollator:
+    """
+    去掉每条样本开头相同的系统提示词段, 只对剩余部分 padding;
+    前缀作为 prefix_ids 单独传给 LoraTrainer。
+    """
+
+    def __init__(self, tokenizer, prefix_ids, pad_to_multiple_of=8):
+        self.prefix_ids = list(prefix_ids)
+        self.collator = DataCollatorForSeq2Seq(tokenizer, pad_to_multiple_of=pad_to_multiple_of)
+
+    def __call__(self, features):
+        prefix_len = len(self.prefix_ids)
+        suffixes = []
+        for feature in features:
+            if feature["input_ids"][:prefix_len] != self.prefix_ids or len(feature["input_ids"]) <= prefix_len:
+                raise ValueError(
+                    "样本没有以共享的系统提示词开头, 或被 MAX_SEQ_LENGTH 截断到只剩系统提示词, "
+                    "无法使用 SHARED_PREFIX_TRAINING"
+                )
+            suffixes.append({key: feature[key][prefix_len:] for key in ("input_ids", "attention_mask", "labels")})
+        batch = self.collator(suffixes)
+        batch["prefix_ids"] = torch.tensor([self.prefix_ids])
+        return batch
+
+
+def shared_prefix_inputs(model, inputs):
+    """
+    对 SharedPrefixCollator 的输出先跑一次前缀 (带梯度), 返回后缀前向所需的输入:
+    沿 batch 维 expand 的前缀 KV、拼上前缀的 attention_mask、从前缀长度开始的 position_ids。
+    反向时每条样本的梯度经 expand 求和, 回到这唯一一次前缀计算。
+    """
+    inputs = dict(inputs)
+    prefix_ids = inputs.pop("prefix_ids")
+    batch_size, suffix_len = inputs["input_ids"].shape
+    prefix_len = prefix_ids.shape[1]
+
+    prefix = model(input_ids=prefix_ids, use_cache=True, logits_to_keep=1)
+    past = prefix.past_key_values
+    legacy = past.to_legacy_cache() if hasattr(past, "to_legacy_cache") else past
+    cache = DynamicCache.from_legacy_cache(tuple(
+        (key.expand(batch_size, -1, -1, -1), value.expand(batch_size, -1, -1, -1)) for key, value in legacy
+    ))
+
+    attention_mask = inputs["attention_mask"]
+    return {
+        **inputs,
+        "attention_mask": torch.cat([attention_mask.new_ones(batch_size, prefix_len), attention_mask], dim=1),
+        "position_ids": torch.arange(prefix_len, prefix_len + suffix_len, device=attention_mask.device).expand(batch_size, -1),
+        "past_key_values": cache,
+    }
+
+
+def target_logits_loss(model, inputs, num_items_in_batch=None, chunk_size=TARGET_LOSS_CHUNK):
+    """
+    位置 p 的 logits 预测 labels[p + 1]; 只把 batch 内任一行有监督的位置作为 logits_to_keep 传给模型,
+    lm_head 只作用在这些隐状态上, 再按 chunk_size 个位置分块 (upcast 到 float32) 计算交叉熵。
+    有 num_items_in_batch 时除以它 (梯度累积), 否则对有效 token 求平均;
+    多卡时按进程数的缩放由 LoraTrainer.compute_loss 负责, 与 Trainer 自带的 loss 路径一致。
+    """
+    inputs = dict(inputs)
+    labels = inputs.pop("labels")
+    shift_labels = torch.cat([labels[:, 1:], labels.new_full((labels.shape[0], 1), -100)], dim=1)
+    keep = (shift_labels != -100).any(dim=0).nonzero().squeeze(-1)
+    outputs = model(**inputs, logits_to_keep=keep)
+    logits, targets = outputs.logits, shift_labels[:, keep]
+
+    # 乘 0 的项保证所有位置都被截断时 loss 仍连着计算图
+    total = logits.sum().float() * 0
+    for start in range(0, logits.shape[1], chunk_size):
+        end = start + chunk_size
+        total = total + F.cross_entropy(
+            logits[:, start:end].float().flatten(0, 1), targets[:, start:end].flatten(),
+            ignore_index=-100, reduction="sum",
+        )
+    if num_items_in_batch is None:
+        num_items_in_batch = (targets != -100).sum().clamp_min(1)
+    return total / num_items_in_batch, outputs
+
+
+class LoraTrainer(Trainer):
+    """
+    shared_prefix: 系统提示词前缀每个 microbatch 只前向一次 (见 shared_prefix_inputs)。
+    prefix 最后一个位置预测的是 prompt 内的 token (label 为 -100), 所以 loss 只需要后缀的 logits, 与标准路径一致。
+    target_only_logits: loss 只在有监督的位置上算 logits (见 target_logits_loss)。
+    """
+
+    def __init__(self, *args, shared_prefix=False, target_only_logits=False, loss_chunk=TARGET_LOSS_CHUNK, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shared_prefix = shared_prefix
+        self.target_only_logits = target_only_logits
+        self.loss_chunk = loss_chunk
+        if shared_prefix and self.args.gradient_checkpointing:
+            raise ValueError("SHARED_PREFIX_TRAINING 需要前缀的 KV cache, 不能与梯度检查点同时使用")
+
+    def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
+        if self.shared_prefix:
+            inputs = shared_prefix_inputs(model, inputs)
+        if not self.target_only_logits:
+            return super().compute_loss(model, inputs, return_outputs, num_items_in_batch)
+        loss, outputs = target_logits_loss(model, inputs, num_items_in_batch, self.loss_chunk)
+        # 与 Trainer.compute_loss 一致: num_items_in_batch 是所有卡的 token 总数时, DDP 对梯度取平均前先乘回进程数
+        if getattr(self.args, "average_tokens_across_devices", False) and num_items_in_batch is not None:
+            loss = loss * self.accelerator.num_processes
+        return (loss, outputs) if return_outputs else loss
+
+
+def make_data_collator(model, tokenizer, system_prompt, packing=False, shared_prefix=False):
+    if shared_prefix:
+        return SharedPrefixCollator(tokenizer, system_prompt_ids(tokenizer, system_prompt))
+    if not packing:
+        return DataCollatorForSeq2Seq(tokenizer, pad_to_multiple_of=8)
+    return PackedDataCollator(
+        tokenizer.pad_token_id,
+        flatten=model.config._attn_implementation == "flash_attention_2",
+        dtype=model.dtype,
+    )
@@ -0,0 +1,38 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.agent import CustomAgent
+from utils.common import load_prompts
+
+# --- 配置 ---
+DATA_FILE = "data/sample_data.jsonl"
+BATCH_SIZES = [1, 4, 16]
+NUM_REQUESTS = 48   # 样本不足时循环补齐，保证每个 batch size 都能跑满
+
+
+def main():
+    agent = CustomAgent()
+    prompts = load_prompts(DATA_FILE)
+    prompts = (prompts * (NUM_REQUESTS // len(prompts) + 1))[:NUM_REQUESTS]
+
+    # 顺序逐条推理作为基线
+    start = time.perf_counter()
+    sequential = [agent.run(history) for history in prompts]
+    seq_time = time.perf_counter() - start
+    print(f"[sequential] {len(prompts)} requests, {seq_time:.2f}s, {len(prompts) / seq_time:.2f} req/s")
+
+    for batch_size in BATCH_SIZES:
+        start = time.perf_counter()
+        batched = agent.run_batch(prompts, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        agree = sum(a == b for a, b in zip(sequential, batched))
+        print(
+            f"[batch={batch_size:>2}] {elapsed:.2f}s, {len(prompts) / elapsed:.2f} req/s, "
+            f"speedup x{seq_time / elapsed:.2f}, same output as sequential: {agree}/{len(prompts)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import os
+import sys
+import json
+import time
+import resource
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import src.agent as agent_module
+from src.agent import CustomAgent
+
+# --- 配置 ---
+# 每条加载路径单独起一个进程，峰值 RSS 才不会互相污染:
+#   python utils/bench_cold_start.py merge    # 基座 + LoRA + merge_and_unload (原路径)
+#   python utils/bench_cold_start.py merged   # 预先导出的 merged safetensors (先跑 utils/export_merged_model.py)
+DATA_FILE = "data/sample_data.jsonl"
+
+
+def load_first_prompt(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            history = json.loads(line)['data'][:-1]
+            if history and history[-1]['role'] == 'user':
+                return history
+    raise ValueError(f"{file_path} 中没有可用样本")
+
+
+def peak_rss_mb():
+    # Linux 上 ru_maxrss 的单位是 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else "merged"
+    if mode == "merge":
+        agent_module.MERGED_MODEL_PATH = None
+    elif not agent_module.merged_model_is_current(
+        agent_module.MERGED_MODEL_PATH, "models/Qwen3-1.7B", "./lora_weights/"
+    ):
+        print("merged 模型不存在或已过期，请先运行 utils/export_merged_model.py")
+        return
+    history = load_first_prompt(DATA_FILE)
+
+    start = time.perf_counter()
+    agent = CustomAgent()
+    ready_time = time.perf_counter() - start
+    agent.run(history)
+    first_response_time = time.perf_counter() - start
+
+    print(
+        f"[{mode}] ready {ready_time:.2f}s, time to first response {first_response_time:.2f}s, "
+        f"peak RSS {peak_rss_mb():.0f}MB"
+    )
+
+
+if __name__ == "__main__":
+    main()
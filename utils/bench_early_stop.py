@@ -0,0 +1,42 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.agent import CustomAgent, STOP_STRINGS, extract_tool_call
+from utils.common import load_prompts
+
+# --- 配置 ---
+DATA_FILE = "data/sample_data.jsonl"
+
+
+def main():
+    agent = CustomAgent()
+    prompts = load_prompts(DATA_FILE)
+
+    baseline_steps, early_steps, same = 0, 0, 0
+    for i, history in enumerate(prompts, start=1):
+        messages = [{"role": "system", "content": agent.system_prompt}] + history
+
+        # 原路径: 固定 max_new_tokens=1024, 只在 EOS 处停止
+        baseline = agent.llm.generate(messages, max_new_tokens=1024, do_sample=False)
+        baseline_stats = agent.llm.last_generation_stats
+
+        # 新路径: 遇到 </tool> 立即停止 + 按子句数/最长签名估算预算
+        budget = agent.estimate_max_new_tokens(history)
+        early = agent.llm.generate(messages, max_new_tokens=budget, stop_strings=STOP_STRINGS, do_sample=False)
+        early_stats = agent.llm.last_generation_stats
+
+        baseline_steps += baseline_stats["decode_steps"]
+        early_steps += early_stats["decode_steps"]
+        same += extract_tool_call(baseline) == extract_tool_call(early)
+        print(
+            f"[{i:>3}] budget={budget:>4} steps {baseline_stats['decode_steps']:>4} -> {early_stats['decode_steps']:>4}"
+        )
+
+    saved = baseline_steps - early_steps
+    print(f"总解码步数: {baseline_steps} -> {early_steps}, 节省 {saved} 步 ({saved / max(baseline_steps, 1):.1%})")
+    print(f"抽取后的工具调用一致: {same}/{len(prompts)}")
+
+
+if __name__ == "__main__":
+    main()
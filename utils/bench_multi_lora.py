@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import resource
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.agent import CustomAgent
+from utils.common import load_prompts
+
+# --- 配置 ---
+# 每种方式单独起一个进程跑，峰值内存才不会互相污染:
+#   python utils/bench_multi_lora.py merged   # 单 adapter, merge_and_unload (原路径)
+#   python utils/bench_multi_lora.py multi    # LORA_ADAPTERS 中的全部 adapter, 不 merge, 共享一份基座
+DATA_FILE = "data/sample_data.jsonl"
+LORA_ADAPTERS = {
+    "default": "./lora_weights/",
+    # "car": "./lora_weights_car/",
+}
+BATCH_SIZE = 8
+
+
+def peak_memory_mb():
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / (1024 * 1024)
+    # Linux 上 ru_maxrss 的单位是 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else "multi"
+    prompts = load_prompts(DATA_FILE)
+
+    start = time.perf_counter()
+    if mode == "merged":
+        agent = CustomAgent(lora_weights_path=next(iter(LORA_ADAPTERS.values())))
+        adapters = [None] * len(prompts)
+    else:
+        agent = CustomAgent(lora_adapters=LORA_ADAPTERS)
+        names = list(LORA_ADAPTERS)
+        # 请求轮流使用各个 adapter, 模拟混合流量
+        adapters = [names[i % len(names)] for i in range(len(prompts))]
+    load_time = time.perf_counter() - start
+    load_memory = peak_memory_mb()
+
+    start = time.perf_counter()
+    for history, adapter in zip(prompts, adapters):
+        agent.run(history, adapter=adapter)
+    sequential_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    agent.run_batch(prompts, batch_size=BATCH_SIZE, adapters=None if mode == "merged" else adapters)
+    batch_time = time.perf_counter() - start
+
+    n = len(prompts)
+    print(
+        f"[{mode}] adapters {1 if mode == 'merged' else len(LORA_ADAPTERS)}, load {load_time:.1f}s, "
+        f"memory after load {load_memory:.0f}MB, peak {peak_memory_mb():.0f}MB"
+    )
+    print(f"  sequential: {sequential_time / n * 1000:.1f}ms/req")
+    print(f"  batch={BATCH_SIZE} ({'mixed adapters' if mode != 'merged' else 'single adapter'}): {n / batch_time:.2f} req/s")
+
+
+if __name__ == "__main__":
+    main()
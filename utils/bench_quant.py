@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import time
+import resource
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.agent import CustomAgent, _PeakMemoryMonitor, _device_live_memory_mb
+
+# --- 配置 ---
+# 每种精度单独起一个进程跑，峰值 RSS 才不会互相污染:
+#   python utils/bench_quant.py bf16
+#   python utils/bench_quant.py int8
+#   python utils/bench_quant.py int4
+DATA_FILE = "data/sample_data.jsonl"
+OUTPUT_DIR = "outputs/bench_quant"
+
+
+def load_samples(file_path):
+    """把每条样本截到最后一个 user 轮，作为推理输入，并保留标注答案"""
+    samples = []
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            history = item['data'][:-1]
+            if history and history[-1]['role'] == 'user':
+                samples.append((history, item['data'][-1]['content']))
+    return samples
+
+
+def peak_rss_mb():
+    # Linux 上 ru_maxrss 的单位是 KB; 进程生命周期内的最大值, 包含加载 / 量化过程
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def weights_mb(model):
+    """参数 + buffer (量化权重与 scale) 实际占用的字节数"""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors) / (1024 * 1024)
+
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else "bf16"
+    quantization = None if mode == "bf16" else mode
+    samples = load_samples(DATA_FILE)
+
+    start = time.perf_counter()
+    agent = CustomAgent(quantization=quantization)
+    load_time = time.perf_counter() - start
+    device = agent.llm.model.device
+    load_memory = _device_live_memory_mb(device)
+
+    # 每条请求单独测峰值 (CPU 上采样 RSS), 不受加载阶段的最大值影响
+    outputs, latencies, request_peak = [], [], 0.0
+    for history, _ in samples:
+        start = time.perf_counter()
+        memory = _PeakMemoryMonitor(device)
+        outputs.append(agent.run(history))
+        request_peak = max(request_peak, memory.stop())
+        latencies.append(time.perf_counter() - start)
+
+    correct = sum(output == label for output, (_, label) in zip(outputs, samples))
+    result = {
+        "mode": mode,
+        "load_s": load_time,
+        "accuracy": correct / len(samples),
+        "avg_latency_ms": sum(latencies) / len(latencies) * 1000,
+        "weights_mb": weights_mb(agent.llm.model),
+        "memory_after_load_mb": load_memory,
+        "request_peak_mb": request_peak,
+        "process_peak_rss_mb": peak_rss_mb(),
+        "outputs": outputs,
+    }
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    with open(os.path.join(OUTPUT_DIR, f"{mode}.json"), 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    print(
+        f"[{mode}] load {load_time:.1f}s, accuracy {correct}/{len(samples)}, "
+        f"avg latency {result['avg_latency_ms']:.1f}ms, weights {result['weights_mb']:.0f}MB, "
+        f"after load {load_memory:.0f}MB, request peak {request_peak:.0f}MB"
+    )
+
+    # 与 bf16 结果对比漂移 (需要先跑过 bf16)
+    reference_path = os.path.join(OUTPUT_DIR, "bf16.json")
+    if mode != "bf16" and os.path.exists(reference_path):
+        with open(reference_path, 'r', encoding='utf-8') as f:
+            reference = json.load(f)
+        drift = sum(a != b for a, b in zip(reference["outputs"], outputs))
+        print(f"与 bf16 输出不一致: {drift}/{len(outputs)}")
+        print(
+            f"准确率 {reference['accuracy']:.3f} -> {result['accuracy']:.3f}, "
+            f"延迟 {reference['avg_latency_ms']:.1f}ms -> {result['avg_latency_ms']:.1f}ms, "
+            f"权重 {reference['weights_mb']:.0f}MB -> {result['weights_mb']:.0f}MB, "
+            f"请求峰值 {reference['request_peak_mb']:.0f}MB -> {result['request_peak_mb']:.0f}MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.agent import CustomAgent, STOP_STRINGS
+from utils.common import load_prompts
+
+# --- 配置 ---
+DATA_FILE = "data/sample_data.jsonl"
+DRAFT_MODEL_PATH = None  # 例如 "models/Qwen3-0.6B"，为 None 时只用 n-gram 草稿
+
+
+def main():
+    agent = CustomAgent(speculative_decoding=True, draft_model_path=DRAFT_MODEL_PATH)
+    prompts = load_prompts(DATA_FILE)
+
+    total_greedy, total_spec, mismatches = 0.0, 0.0, 0
+    for i, history in enumerate(prompts, start=1):
+        messages = [{"role": "system", "content": agent.system_prompt}] + history
+        budget = agent.estimate_max_new_tokens(history)
+
+        start = time.perf_counter()
+        greedy = agent.llm.generate(messages, max_new_tokens=budget, stop_strings=STOP_STRINGS, do_sample=False)
+        greedy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        spec = agent.llm.generate(messages, max_new_tokens=budget, stop_strings=STOP_STRINGS, speculative=True)
+        spec_time = time.perf_counter() - start
+        stats = agent.llm.last_generation_stats
+
+        total_greedy += greedy_time
+        total_spec += spec_time
+        if greedy != spec:
+            mismatches += 1
+        print(
+            f"[{i:>3}] accept {stats['accepted_tokens']:>3}/{stats['drafted_tokens']:<3} ({stats['acceptance_rate']:.0%}) "
+            f"steps {stats['decode_steps']:>3}/{stats['generated_tokens']:<3} "
+            f"{greedy_time * 1000:7.1f}ms -> {spec_time * 1000:7.1f}ms (x{greedy_time / spec_time:.2f})"
+            + ("  [MISMATCH]" if greedy != spec else "")
+        )
+
+    print(f"总耗时: {total_greedy:.2f}s -> {total_spec:.2f}s, 加速 x{total_greedy / total_spec:.2f}")
+    print(f"与贪心解码输出不一致: {mismatches}/{len(prompts)}")
+
+
+if __name__ == "__main__":
+    main()
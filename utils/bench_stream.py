@@ -0,0 +1,67 @@
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.agent import CustomAgent
+
+# --- 配置 ---
+DATA_FILE = "data/sample_data.jsonl"
+
+
+def load_multi_instruction_prompts(file_path):
+    """只取多指令样本，截到最后一个 user 轮"""
+    prompts = []
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            history = item['data'][:-1]
+            if '多指令' in item.get('subcategory', '') and history and history[-1]['role'] == 'user':
+                prompts.append(history)
+    return prompts
+
+
+def main():
+    agent = CustomAgent()
+    prompts = load_multi_instruction_prompts(DATA_FILE)
+
+    total_run, total_first, total_stream, same = 0.0, 0.0, 0.0, 0
+    for i, history in enumerate(prompts, start=1):
+        start = time.perf_counter()
+        full = agent.run(history)
+        run_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        calls, first_action = [], None
+        for call in agent.run_stream(history):
+            if first_action is None:
+                first_action = time.perf_counter() - start
+            calls.append(call)
+        stream_time = time.perf_counter() - start
+        first_action = first_action if first_action is not None else stream_time
+
+        total_run += run_time
+        total_first += first_action
+        total_stream += stream_time
+        # run() 保留原始分隔符的写法 ("|" 或 " | "), 按调用逐个比较
+        expected = [call.strip() for call in full.split('|') if call.strip()]
+        same += calls == expected
+        print(
+            f"[{i:>3}] {len(calls)} calls, first action {first_action * 1000:7.1f}ms, "
+            f"all {stream_time * 1000:7.1f}ms, run() {run_time * 1000:7.1f}ms"
+        )
+
+    n = max(len(prompts), 1)
+    print(
+        f"多指令样本 {len(prompts)} 条: 首个动作平均 {total_first / n * 1000:.1f}ms, "
+        f"run() 平均 {total_run / n * 1000:.1f}ms (x{total_run / max(total_first, 1e-9):.2f})"
+    )
+    print(f"流式输出与 run() 一致: {same}/{len(prompts)}")
+
+
+if __name__ == "__main__":
+    main()
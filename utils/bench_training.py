@@ -0,0 +1,193 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+import torch
+from peft import LoraConfig, get_peft_model
+from transformers import AutoModelForCausalLM, AutoTokenizer, DataCollatorForSeq2Seq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+import finetune
+from train_utils import (
+    PackedDataset, PackedDataCollator, SharedPrefixCollator, shared_prefix_inputs, system_prompt_ids, target_logits_loss,
+)
+
+# 用法 (每种模式单独一个进程, 峰值显存互不影响):
+#   python utils/bench_training.py --mode padded --batch-size 1 --full-logits   # 原始训练路径, 作为对比基线
+#   python utils/bench_training.py --mode padded --batch-size 1
+#   python utils/bench_training.py --mode packed --batch-size 1
+#   python utils/bench_training.py --mode packed --attn flash_attention_2
+#   python utils/bench_training.py --mode padded --batch-size 8 --full-logits
+#   python utils/bench_training.py --mode shared_prefix --batch-size 8 --check-parity
+#   python utils/bench_training.py --max-seq-length 6000 --full-logits && python utils/bench_training.py --max-seq-length 6000
+# 只计优化器步之间的时间; 第一步 (CUDA 初始化 / autotune) 不计入。
+OUTPUT_DIR = "outputs/bench_training"
+
+
+def make_batches(args, dataset, tokenizer, model, prefix_ids):
+    """返回 [(collate 后的 batch, 样本 token 数, 实际计算的非 padding 位置数)]"""
+    prefix_len = 0
+    if args.mode == "padded":
+        features = [dataset[i] for i in range(len(dataset))]
+        collator = DataCollatorForSeq2Seq(tokenizer, pad_to_multiple_of=8)
+    elif args.mode == "shared_prefix":
+        features = [dataset[i] for i in range(len(dataset))]
+        collator = SharedPrefixCollator(tokenizer, prefix_ids)
+        prefix_len = len(prefix_ids)
+    else:
+        packed = PackedDataset(dataset, finetune.MAX_SEQ_LENGTH)
+        features = [packed[i] for i in range(len(packed))]
+        collator = PackedDataCollator(
+            tokenizer.pad_token_id, flatten=args.attn == "flash_attention_2", dtype=model.dtype
+        )
+    batches = []
+    for start in range(0, len(features), args.batch_size):
+        chunk = features[start:start + args.batch_size]
+        tokens = sum(len(feature["input_ids"]) for feature in chunk)
+        # 共享前缀模式下每个 batch 只算一份前缀
+        batches.append((collator(chunk), tokens, tokens - prefix_len * (len(chunk) - 1)))
+    return batches
+
+
+def compute_loss(args, model, batch):
+    if args.mode == "shared_prefix":
+        batch = shared_prefix_inputs(model, batch)
+    if args.full_logits:
+        return model(**batch).loss
+    return target_logits_loss(model, batch, chunk_size=finetune.TARGET_LOSS_CHUNK)[0]
+
+
+def check_parity(args, model, dataset, tokenizer, prefix_ids):
+    """同一批样本分别走标准路径 (逐条 padding + 全量 logits) 与当前配置的路径 (关闭 dropout), 比较 loss 与 LoRA 梯度"""
+    features = [dataset[i] for i in range(min(args.batch_size, len(dataset)))]
+    standard = DataCollatorForSeq2Seq(tokenizer, pad_to_multiple_of=8)(features)
+    if args.mode == "shared_prefix":
+        configured = SharedPrefixCollator(tokenizer, prefix_ids)(features)
+    else:
+        configured = standard
+    params = [(name, p) for name, p in model.named_parameters() if p.requires_grad]
+
+    model.eval()
+    results = []
+    for batch, is_standard in ((standard, True), (configured, False)):
+        batch = {key: value.cuda() for key, value in batch.items()}
+        loss = model(**batch).loss if is_standard else compute_loss(args, model, batch)
+        loss.backward()
+        results.append((loss.item(), {name: p.grad.float().clone() for name, p in params}))
+        model.zero_grad(set_to_none=True)
+    model.train()
+
+    (standard_loss, standard_grads), (configured_loss, configured_grads) = results
+    grad_error = max(
+        ((standard_grads[name] - configured_grads[name]).norm() / standard_grads[name].norm().clamp_min(1e-12)).item()
+        for name in standard_grads
+    )
+    print(f"[parity] loss {standard_loss:.6f} vs {configured_loss:.6f} (差 {abs(standard_loss - configured_loss):.2e}), "
+          f"LoRA 梯度最大相对误差 {grad_error:.2e}")
+    return {"standard_loss": standard_loss, "configured_loss": configured_loss, "max_grad_rel_error": grad_error}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LoRA 训练步吞吐: tokens/s 与 padding 占比")
+    parser.add_argument("--mode", choices=["padded", "packed", "shared_prefix"], default="padded")
+    parser.add_argument("--model", default=finetune.MODEL_PATH)
+    parser.add_argument("--attn", default="sdpa", help="sdpa / eager / flash_attention_2")
+    parser.add_argument("--batch-size", type=int, default=finetune.BATCH_SIZE)
+    parser.add_argument("--max-seq-length", type=int, default=finetune.MAX_SEQ_LENGTH)
+    parser.add_argument("--samples", type=int, default=512, help="参与评测的样本数")
+    parser.add_argument("--check-parity", action="store_true", help="先比较当前配置与标准路径的 loss/梯度 (packed 除外)")
+    parser.add_argument("--full-logits", action="store_true", help="用模型自带的 loss (全部位置的 logits)")
+    args = parser.parse_args()
+    finetune.MAX_SEQ_LENGTH = args.max_seq_length
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True, use_fast=True)
+    tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(
+        args.model, trust_remote_code=True, torch_dtype=torch.bfloat16, attn_implementation=args.attn
+    ).cuda()
+    model.config.use_cache = False
+    model = get_peft_model(model, LoraConfig(
+        r=finetune.LORA_R,
+        lora_alpha=finetune.LORA_ALPHA,
+        target_modules=finetune.LORA_TARGET_MODULES,
+        lora_dropout=finetune.LORA_DROPOUT,
+        bias="none",
+        task_type="CAUSAL_LM",
+    ))
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=finetune.LEARNING_RATE)
+
+    system_prompt = finetune.create_system_prompt()
+    prefix_ids = system_prompt_ids(tokenizer, system_prompt)
+    dataset = finetune.process_dataset(tokenizer, system_prompt)
+    dataset = dataset.select(range(min(args.samples, len(dataset))))
+    parity = None
+    if args.check_parity and args.mode != "packed":
+        parity = check_parity(args, model, dataset, tokenizer, prefix_ids)
+    batches = make_batches(args, dataset, tokenizer, model, prefix_ids)
+
+    model.train()
+    real_tokens, computed_tokens, slots, losses = 0, 0, 0, []
+    torch.cuda.reset_peak_memory_stats()
+    for step, (batch, tokens, computed) in enumerate(batches):
+        if step == 1:
+            torch.cuda.synchronize()
+            start = time.perf_counter()
+        batch = {key: value.cuda() for key, value in batch.items()}
+        positions = batch["input_ids"].numel() + (batch["prefix_ids"].numel() if "prefix_ids" in batch else 0)
+        loss = compute_loss(args, model, batch)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        losses.append(loss.item())
+        if step >= 1:
+            real_tokens += tokens
+            computed_tokens += computed
+            slots += positions
+    torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start if len(batches) > 1 else 0.0
+
+    result = {
+        "mode": args.mode,
+        "attn": args.attn,
+        "batch_size": args.batch_size,
+        "max_seq_length": args.max_seq_length,
+        "logits": "full" if args.full_logits else "target",
+        "samples": len(dataset),
+        "steps": len(batches),
+        "tokens_per_s": real_tokens / elapsed if elapsed else 0.0,
+        "step_time_ms": elapsed / max(len(batches) - 1, 1) * 1000,
+        "padding_fraction": 1 - computed_tokens / max(slots, 1),
+        "peak_memory_mb": torch.cuda.max_memory_allocated() / 1024 ** 2,
+        "mean_loss": sum(losses) / max(len(losses), 1),
+        "parity": parity,
+    }
+    name = f"{args.mode}_{args.attn}_bs{args.batch_size}_len{args.max_seq_length}" + ("_full" if args.full_logits else "")
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    with open(os.path.join(OUTPUT_DIR, f"{name}.json"), 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    print(
+        f"[{name}] {result['steps']} 步, {result['tokens_per_s']:.0f} tokens/s, "
+        f"单步 {result['step_time_ms']:.0f}ms, padding {result['padding_fraction']:.1%}, "
+        f"峰值显存 {result['peak_memory_mb']:.0f}MB"
+    )
+
+    # 与原始训练路径 (逐条 padding + 全量 logits) 对比, 需要先以相同参数跑过 --mode padded --full-logits
+    reference_name = f"padded_{args.attn}_bs{args.batch_size}_len{args.max_seq_length}_full"
+    reference_path = os.path.join(OUTPUT_DIR, f"{reference_name}.json")
+    if name != reference_name and os.path.exists(reference_path):
+        with open(reference_path, 'r', encoding='utf-8') as f:
+            reference = json.load(f)
+        print(
+            f"tokens/s {reference['tokens_per_s']:.0f} -> {result['tokens_per_s']:.0f} "
+            f"({result['tokens_per_s'] / max(reference['tokens_per_s'], 1e-9):.2f}x), "
+            f"单步 {reference['step_time_ms']:.0f}ms -> {result['step_time_ms']:.0f}ms, "
+            f"padding {reference['padding_fraction']:.1%} -> {result['padding_fraction']:.1%}, "
+            f"峰值显存 {reference['peak_memory_mb']:.0f}MB -> {result['peak_memory_mb']:.0f}MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
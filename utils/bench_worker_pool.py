@@ -0,0 +1,41 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.agent import AgentWorkerPool
+from utils.common import load_prompts
+
+# --- 配置 ---
+# 需要先运行 utils/export_merged_model.py 导出 merged 模型, worker 通过 mmap 共享这份权重
+DATA_FILE = "data/sample_data.jsonl"
+NUM_REQUESTS = 64   # 样本不足时循环补齐
+MAX_WORKERS = max(len(os.sched_getaffinity(0)) // 4, 1)   # 每个 worker 至少 4 个核
+
+
+def main():
+    prompts = load_prompts(DATA_FILE)
+    prompts = (prompts * (NUM_REQUESTS // len(prompts) + 1))[:NUM_REQUESTS]
+    worker_counts = sorted({1, 2, 4, 8, MAX_WORKERS} & set(range(1, MAX_WORKERS + 1)))
+
+    print(f"{'workers':>7} | {'cores/worker':>12} | {'req/s':>7} | {'scaling':>7} | {'total PSS MB':>12} | {'MB/worker':>9}")
+    base_throughput = None
+    for num_workers in worker_counts:
+        pool = AgentWorkerPool(num_workers, warmup_runs=1)
+        start = time.perf_counter()
+        pool.map(prompts)
+        elapsed = time.perf_counter() - start
+        memory = pool.memory_usage()
+        pool.close()
+
+        throughput = len(prompts) / elapsed
+        base_throughput = base_throughput or throughput
+        total_mb = sum(memory.values())
+        print(
+            f"{num_workers:>7} | {len(os.sched_getaffinity(0)) // num_workers:>12} | {throughput:>7.2f} | "
+            f"x{throughput / base_throughput:>6.2f} | {total_mb:>12.0f} | {total_mb / num_workers:>9.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import time
+import argparse
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.agent import CustomAgent, HistogramSink
+
+# 用法:
+#   python utils/benchmark.py                                    # 默认模型 + sample_data
+#   python utils/benchmark.py --model models/tiny --lora none --limit 20 --output outputs/ci.json
+#   python utils/benchmark.py --baseline outputs/last.json       # 与上一次结果比较, 退化时返回非 0
+# CI 上可以用任意小模型 (CPU 即可), 关注的是延迟/准确率相对基线的变化, 而不是绝对值。
+ACCURACY_TOLERANCE = 0.01   # 准确率下降超过该值视为退化
+LATENCY_TOLERANCE = 0.20    # p95 延迟上升超过 20% 视为退化
+
+
+class RecordingSink(HistogramSink):
+    """在直方图之外保留每条记录 (峰值显存/内存、token 数)"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+        super().emit(record)
+
+
+def load_cases(file_path, limit=None):
+    """多轮样本的每个 assistant 轮都是一个用例: (之前的对话, 参考答案, subcategory, difficulty)"""
+    cases = []
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            dialogue = item['data']
+            for i, turn in enumerate(dialogue):
+                if turn['role'] == 'assistant' and i > 0 and dialogue[i - 1]['role'] == 'user':
+                    cases.append((dialogue[:i], turn['content'].strip(), item.get('subcategory', '未知'), item.get('difficulty', 0)))
+    return cases[:limit] if limit else cases
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(int(round(q * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def group_accuracy(results, key):
+    groups = defaultdict(lambda: [0, 0])
+    for result in results:
+        groups[str(result[key])][0] += result['correct']
+        groups[str(result[key])][1] += 1
+    return {name: {"accuracy": hit / total, "count": total} for name, (hit, total) in sorted(groups.items())}
+
+
+def check_regression(report, baseline_path):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    problems = []
+    if report['accuracy'] < baseline['accuracy'] - ACCURACY_TOLERANCE:
+        problems.append(f"准确率 {baseline['accuracy']:.3f} -> {report['accuracy']:.3f}")
+    if report['latency_ms']['p95'] > baseline['latency_ms']['p95'] * (1 + LATENCY_TOLERANCE):
+        problems.append(f"p95 延迟 {baseline['latency_ms']['p95']:.1f}ms -> {report['latency_ms']['p95']:.1f}ms")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回放 JSONL 对话, 评测 CustomAgent.run 的准确率与延迟")
+    parser.add_argument("--data", default="data/sample_data.jsonl")
+    parser.add_argument("--model", default="models/Qwen3-1.7B")
+    parser.add_argument("--lora", default="./lora_weights/", help="'none' 表示不加载 LoRA")
+    parser.add_argument("--limit", type=int, default=None, help="只跑前 N 个用例")
+    parser.add_argument("--output", default="outputs/benchmark.json")
+    parser.add_argument("--baseline", default=None, help="上一次的结果文件, 用于检测退化")
+    args = parser.parse_args()
+
+    cases = load_cases(args.data, args.limit)
+    sink = RecordingSink()
+    start = time.perf_counter()
+    agent = CustomAgent(
+        base_model_path=args.model,
+        lora_weights_path=None if args.lora == "none" else args.lora,
+        metrics_sink=sink,
+    )
+    load_time = time.perf_counter() - start
+
+    results = []
+    start = time.perf_counter()
+    for history, reference, subcategory, difficulty in cases:
+        case_start = time.perf_counter()
+        output = agent.run(history)
+        latency = (time.perf_counter() - case_start) * 1000
+        results.append({
+            "subcategory": subcategory,
+            "difficulty": difficulty,
+            "turns": len(history),
+            "correct": output.strip() == reference,
+            "latency_ms": latency,
+            "output": output,
+            "reference": reference,
+        })
+    elapsed = time.perf_counter() - start
+
+    latencies = [result['latency_ms'] for result in results]
+    generated_tokens = sum(record.get('generated_tokens', 0) for record in sink.records)
+    report = {
+        "data": args.data,
+        "model": args.model,
+        "lora": args.lora,
+        "cases": len(results),
+        "load_s": load_time,
+        "accuracy": sum(result['correct'] for result in results) / max(len(results), 1),
+        "accuracy_by_subcategory": group_accuracy(results, 'subcategory'),
+        "accuracy_by_difficulty": group_accuracy(results, 'difficulty'),
+        "latency_ms": {
+            "mean": sum(latencies) / max(len(latencies), 1),
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+        },
+        "throughput": {
+            "requests_per_s": len(results) / elapsed if elapsed else 0.0,
+            "generated_tokens_per_s": generated_tokens / elapsed if elapsed else 0.0,
+        },
+        "peak_memory_mb": max((record['peak_memory_mb'] for record in sink.records), default=0.0),
+        "stages": sink.summary(),
+        "results": results,
+    }
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"用例 {report['cases']}, 准确率 {report['accuracy']:.3f}, 加载 {load_time:.1f}s")
+    for name, group in report['accuracy_by_subcategory'].items():
+        print(f"  {name}: {group['accuracy']:.3f} ({group['count']})")
+    latency = report['latency_ms']
+    print(
+        f"延迟 p50 {latency['p50']:.1f}ms / p95 {latency['p95']:.1f}ms / p99 {latency['p99']:.1f}ms, "
+        f"吞吐 {report['throughput']['requests_per_s']:.2f} req/s, 峰值内存 {report['peak_memory_mb']:.0f}MB"
+    )
+    print(f"结果已写入 {args.output}")
+
+    if args.baseline:
+        problems = check_regression(report, args.baseline)
+        for problem in problems:
+            print(f"[退化] {problem}")
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
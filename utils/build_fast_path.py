@@ -0,0 +1,83 @@
+import os
+import sys
+import json
+import time
+from itertools import groupby
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.agent import SYSTEM_PROMPT, FastPathIndex, parse_tool_schema
+from utils.common import TRAIN_DATA_FILES, SAMPLE_DATA_FILE
+
+# --- 配置 ---
+# 索引只用训练集构建, 在 sample_data 上调阈值, 避免评测数据泄漏进索引
+EVAL_FILE = SAMPLE_DATA_FILE
+OUTPUT_PATH = "./fast_path.json"
+
+
+def load_eval_cases(file_path):
+    """所有样本的最后一轮 (单轮样本才可能走快速通道, 多轮样本计入总流量)"""
+    cases = []
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            dialogue = json.loads(line)['data']
+            if len(dialogue) >= 2 and dialogue[-1]['role'] == 'assistant':
+                cases.append((dialogue[:-1], dialogue[-1]['content'].strip()))
+    return cases
+
+
+def tune_threshold(results):
+    """阈值从高往低扫, 取不产生任何错误的最低阈值 (服务的流量最多)"""
+    answered = sorted(((confidence, correct) for call, confidence, correct in results if call), reverse=True)
+    threshold, served = 1.0, 0
+    for confidence, group in groupby(answered, key=lambda item: item[0]):
+        group = list(group)
+        if not all(correct for _, correct in group):
+            # 同一置信度要么全收要么全不收; 出错的这一档必须被挡在阈值之外
+            threshold = confidence + 1e-6 if not served else threshold
+            break
+        threshold, served = confidence, served + len(group)
+    return threshold
+
+
+def evaluate(results, threshold):
+    answered = [correct for call, confidence, correct in results if call and confidence >= threshold]
+    return len(answered), answered.count(False)
+
+
+def main():
+    missing = [path for path in TRAIN_DATA_FILES if not os.path.exists(path)]
+    for path in missing:
+        print(f"[跳过] 文件不存在: {path}")
+    index = FastPathIndex.build(TRAIN_DATA_FILES, parse_tool_schema(SYSTEM_PROMPT))
+    eligible = sum(1 for counts in index.entries.values() if None not in counts)
+    print(f"索引: {len(index.entries)} 条话术, 其中 {eligible} 条可直接回答")
+
+    cases = load_eval_cases(EVAL_FILE)
+    start = time.perf_counter()
+    predictions = [index.predict(history) for history, _ in cases]
+    latency_us = (time.perf_counter() - start) / max(len(cases), 1) * 1e6
+
+    # 偶数条调阈值, 奇数条留出验证; 只有留出集上也没有错误才保存低于 1.0 的阈值
+    results = [(call, confidence, call == reference) for (call, confidence), (_, reference) in zip(predictions, cases)]
+    tune, held_out = results[0::2], results[1::2]
+    threshold = tune_threshold(tune)
+    served, errors = evaluate(tune, threshold)
+    print(f"调得的阈值: {threshold:.3f}" + (" (>1, 快速通道实际关闭)" if threshold > 1 else ""))
+    print(f"调参集 {len(tune)} 条, 快速通道回答 {served} 条 ({served / max(len(tune), 1):.1%}), 错误 {errors} 条")
+    served, errors = evaluate(held_out, threshold)
+    print(f"留出集 {len(held_out)} 条, 快速通道回答 {served} 条 ({served / max(len(held_out), 1):.1%}), 错误 {errors} 条")
+    if threshold < 1.0 and errors:
+        print("留出集上有错误, 改用 1.0 (只回答完全一致的话术)")
+        threshold = 1.0
+    print(f"平均查询耗时 {latency_us:.1f}us")
+
+    index.threshold = threshold
+    index.save(OUTPUT_PATH)
+    print(f"索引已写入 {OUTPUT_PATH}, 在 agent.py 中设置 FAST_PATH_INDEX_PATH 即可启用")
+
+
+if __name__ == "__main__":
+    main()
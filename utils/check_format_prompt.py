@@ -0,0 +1,87 @@
+import os
+import sys
+import json
+import time
+
+from transformers import AutoTokenizer
+
+# finetune.py / train_utils.py 用 `from agent import ...`, 需要 src 在 sys.path 上
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+from finetune import MODEL_PATH, MAX_SEQ_LENGTH, TRAIN_DATA_FILES, create_system_prompt
+from train_utils import make_format_prompt
+from agent import compact_history, HISTORY_MAX_TOKENS
+
+# 对比新旧 format_prompt 的 input_ids / labels 是否逐 token 一致, 并报告预处理耗时
+DATA_FILES = TRAIN_DATA_FILES + ["data/sample_data.jsonl"]
+
+
+def reference_format_prompt(tokenizer, system_prompt):
+    """改动前的实现: 完整模板分词一次, prompt 部分再分词一次得到 label 边界 (慢速分词器)"""
+    def format_prompt(example):
+        dialogue_history = example['data']
+        target = dialogue_history.pop()
+        dialogue_history = compact_history(dialogue_history, tokenizer, HISTORY_MAX_TOKENS)
+        messages = [{"role": "system", "content": system_prompt}]
+        for turn in dialogue_history:
+            messages.append({"role": turn['role'], "content": turn['content']})
+        full_prompt_text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        final_text = full_prompt_text + f"<tool>{target['content']}</tool>" + tokenizer.eos_token
+        tokenized = tokenizer(final_text, truncation=True, max_length=MAX_SEQ_LENGTH, padding=False)
+        input_ids_len = len(tokenizer(full_prompt_text, truncation=True, max_length=MAX_SEQ_LENGTH)["input_ids"])
+        labels = tokenized['input_ids'][:]
+        labels[:input_ids_len] = [-100] * input_ids_len
+        return {"input_ids": tokenized['input_ids'], "labels": labels}
+
+    return format_prompt
+
+
+def load_examples(file_paths):
+    examples = []
+    for file_path in file_paths:
+        if not os.path.exists(file_path):
+            print(f"[跳过] 文件不存在: {file_path}")
+            continue
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                item = json.loads(line)
+                if item.get('data') and item['data'][-1]['role'] == 'assistant':
+                    examples.append(item['data'])
+    return examples
+
+
+def run(format_prompt, examples):
+    start = time.perf_counter()
+    # format_prompt 会 pop 掉目标轮, 每次传入副本
+    outputs = [format_prompt({"data": list(dialogue)}) for dialogue in examples]
+    return outputs, time.perf_counter() - start
+
+
+def main():
+    system_prompt = create_system_prompt()
+    examples = load_examples(DATA_FILES)
+    slow = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True, use_fast=False)
+    fast = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True, use_fast=True)
+
+    reference, reference_time = run(reference_format_prompt(slow, system_prompt), examples)
+    outputs, elapsed = run(make_format_prompt(fast, system_prompt, MAX_SEQ_LENGTH), examples)
+
+    mismatches = 0
+    for i, (expected, actual) in enumerate(zip(reference, outputs)):
+        if expected['input_ids'] != actual['input_ids'] or expected['labels'] != actual['labels']:
+            mismatches += 1
+            if mismatches <= 5:
+                boundary = [sum(label == -100 for label in out['labels']) for out in (expected, actual)]
+                print(f"[不一致] 样本 {i}: 长度 {len(expected['input_ids'])} vs {len(actual['input_ids'])}, "
+                      f"label 边界 {boundary[0]} vs {boundary[1]}")
+
+    print(f"样本 {len(examples)}, 不一致 {mismatches}")
+    print(f"单进程预处理: 旧 {reference_time:.2f}s -> 新 {elapsed:.2f}s ({reference_time / max(elapsed, 1e-9):.1f}x)")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
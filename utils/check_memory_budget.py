@@ -0,0 +1,42 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.agent import CustomAgent, MemoryBudgetError
+from utils.common import load_prompts
+
+# --- 配置 ---
+# CPU 上用 RSS 记账: python utils/check_memory_budget.py 5120
+DATA_FILE = "data/sample_data.jsonl"
+DEFAULT_BUDGET_MB = 5120
+
+
+def main():
+    budget_mb = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_BUDGET_MB
+    agent = CustomAgent(memory_budget_mb=budget_mb)
+    budget = agent.llm.memory_budget
+    prompts = load_prompts(DATA_FILE)
+
+    peak = 0.0
+    for i, history in enumerate(prompts, start=1):
+        agent.run(history)
+        stats = agent.llm.last_generation_stats
+        peak = max(peak, stats['peak_memory_mb'])
+        print(
+            f"[{i:>3}] prompt {stats['prompt_tokens']:>5} tok, live {stats['live_memory_mb']:7.0f}MB, "
+            f"peak {stats['peak_memory_mb']:7.0f}MB"
+        )
+
+    # 超长请求应被拒绝, 而不是 OOM
+    messages = [{"role": "system", "content": agent.system_prompt}, {"role": "user", "content": "打开蓝牙" * budget.max_context_len}]
+    try:
+        agent.llm.generate(messages, max_new_tokens=16, do_sample=False)
+        print("超长请求未被拒绝 ❌")
+    except MemoryBudgetError as e:
+        print(f"超长请求被拒绝 ✅ ({e})")
+
+    print(f"预算 {budget_mb}MB, 最大峰值 {peak:.0f}MB, 超预算请求 {budget.over_budget_requests}/{len(prompts)}")
+
+
+if __name__ == "__main__":
+    main()
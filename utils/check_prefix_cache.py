@@ -0,0 +1,35 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.agent import CustomAgent
+from utils.common import load_prompts
+
+# --- 配置 ---
+DATA_FILE = "data/sample_data.jsonl"
+MAX_NEW_TOKENS = 128
+
+
+def main():
+    agent = CustomAgent()
+    prompts = load_prompts(DATA_FILE)
+
+    mismatches = 0
+    for i, history in enumerate(prompts, start=1):
+        messages = [{"role": "system", "content": agent.system_prompt}] + history
+        same, without_cache, with_cache = agent.llm.verify_prefix_cache(messages, max_new_tokens=MAX_NEW_TOKENS)
+        if not same:
+            mismatches += 1
+            print(f"[MISMATCH] sample {i}")
+            print(f"  no cache : {without_cache}")
+            print(f"  cache    : {with_cache}")
+
+    print(f"检查完成: {len(prompts)} 条样本, {mismatches} 条输出不一致")
+    if mismatches == 0:
+        print("前缀 KV 缓存与完整 prefill 的贪心输出完全一致 ✅")
+    else:
+        print("前缀 KV 缓存输出存在差异 ❌")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import os
+import sys
+
+import torch
+from transformers import AutoTokenizer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.agent import RadixKVCache, SYSTEM_PROMPT, extract_tool_call
+
+# 1) 合成 KV (第 i 个位置的值就是 i) 检查 RadixKVCache: KV 比 token 多时只存 token 对应的部分,
+#    第 N+1 轮能取回第 N 轮 (prompt + 回复) 的全部 KV, 内存统计与节点内容一致。不需要模型。
+# 2) 有分词器时, 用真实的对话模板统计第 N+1 轮能复用多少 token:
+#    客户端回传原始输出 (<tool>...</tool>) 与回传 run() 返回的提取后调用两种情况。
+MODEL_PATH = "models/Qwen3-1.7B"
+NUM_LAYERS = 2
+
+
+def fake_kv(length):
+    positions = torch.arange(length, dtype=torch.float32).view(1, 1, length, 1)
+    return [(positions.clone(), positions.clone()) for _ in range(NUM_LAYERS)]
+
+
+def tree_nodes(cache):
+    stack, nodes = list(cache.root.children.values()), []
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.children.values())
+    return nodes
+
+
+def check_synthetic():
+    cache = RadixKVCache(max_bytes=1 << 20)
+    turn_n = list(range(100, 110))
+    # 提前停止后 cache 里多出 2 个位置 (已生成但未计入 token 序列)
+    cache.insert(turn_n, fake_kv(len(turn_n) + 2))
+    # 第二个会话与第一个共享前 6 个 token, 触发一次分裂
+    cache.insert(turn_n[:6] + [7, 8, 9], fake_kv(9))
+
+    problems = []
+    for node in tree_nodes(cache):
+        for k, v in node.kv:
+            if k.shape[2] != len(node.tokens) or v.shape[2] != len(node.tokens):
+                problems.append(f"节点 {node.tokens[:3]}... KV 长度 {k.shape[2]} != token 数 {len(node.tokens)}")
+    stored = sum(node.nbytes for node in tree_nodes(cache))
+    if stored != cache.total_bytes:
+        problems.append(f"total_bytes {cache.total_bytes} != 各节点之和 {stored}")
+
+    turn_n1 = turn_n + [200, 201, 202]
+    past = cache.match(turn_n1)
+    if past is None or past.get_seq_length() != len(turn_n):
+        problems.append(f"第 N+1 轮只命中 {0 if past is None else past.get_seq_length()}/{len(turn_n)} 个 token")
+    else:
+        keys = past.to_legacy_cache()[0][0].flatten().tolist()
+        if keys != [float(i) for i in range(len(turn_n))]:
+            problems.append(f"第 N+1 轮取回的 KV 位置不对: {keys}")
+
+    for problem in problems:
+        print(f"[不一致] {problem}")
+    print(f"合成检查: {'通过' if not problems else '失败'}")
+    return not problems
+
+
+def reused_tokens(tokenizer, turn_n_ids, history, assistant_content):
+    messages = history + [
+        {"role": "assistant", "content": assistant_content},
+        {"role": "user", "content": "再把音量调到30"},
+    ]
+    text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    turn_n1_ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+    cache = RadixKVCache(max_bytes=1 << 30)
+    cache.insert(turn_n_ids, fake_kv(len(turn_n_ids)))
+    past = cache.match(turn_n1_ids)
+    return (0 if past is None else past.get_seq_length()), len(turn_n1_ids)
+
+
+def check_template():
+    if not os.path.exists(MODEL_PATH):
+        print(f"[跳过] 模板检查需要 {MODEL_PATH} 的分词器")
+        return
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
+    history = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": "打开蓝牙"}]
+    prompt = tokenizer.apply_chat_template(history, tokenize=False, add_generation_prompt=True)
+    raw_output = '<tool>OpenBluetooth()</tool>'
+    # 第 N 轮缓存的是 prompt + 生成的 token (最后一个采样出的 token 不在 cache 里)
+    turn_n_ids = tokenizer(prompt + raw_output + tokenizer.eos_token, add_special_tokens=False)["input_ids"][:-1]
+    prompt_len = len(tokenizer(prompt, add_special_tokens=False)["input_ids"])
+
+    for name, content in (("回传原始输出", raw_output), ("回传提取后的调用", extract_tool_call(raw_output))):
+        reused, total = reused_tokens(tokenizer, turn_n_ids, history, content)
+        print(f"{name}: 第 N+1 轮 {total} 个 token 中复用 {reused} 个 (第 N 轮 prompt {prompt_len}, 含回复 {len(turn_n_ids)})")
+
+
+def main():
+    ok = check_synthetic()
+    check_template()
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
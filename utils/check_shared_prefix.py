@@ -0,0 +1,103 @@
+import os
+import sys
+
+import torch
+from peft import LoraConfig, get_peft_model
+from transformers import Qwen3Config, Qwen3ForCausalLM
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+from finetune import LORA_TARGET_MODULES
+from train_utils import shared_prefix_inputs, target_logits_loss
+
+# 随机初始化的小 Qwen3 (CPU, float32) 上检查:
+#   共享前缀路径 (前缀只前向一次, KV 广播) 与完整序列路径的 loss / LoRA 梯度一致;
+#   只算目标位置 logits 的 loss 与模型自带 loss 一致。
+# 不需要下载模型:  python utils/check_shared_prefix.py
+TOLERANCE = 1e-4
+PREFIX_LEN = 24
+SUFFIX_LENS = [9, 15, 6, 12]
+TARGET_LENS = [3, 5, 2, 4]  # 每条后缀末尾有监督的 token 数, 其余为 -100
+PAD_ID = 0
+
+
+def build_model():
+    torch.manual_seed(0)
+    config = Qwen3Config(
+        vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, head_dim=16, max_position_embeddings=256,
+    )
+    model = Qwen3ForCausalLM(config)
+    model = get_peft_model(model, LoraConfig(
+        r=4, lora_alpha=8, target_modules=LORA_TARGET_MODULES, lora_dropout=0.0, bias="none", task_type="CAUSAL_LM",
+        init_lora_weights=False,  # 非零 B 矩阵, 前缀上的 LoRA 梯度才有意义
+    ))
+    model.eval()
+    return model
+
+
+def build_batches():
+    generator = torch.Generator().manual_seed(1)
+    prefix = torch.randint(1, 128, (PREFIX_LEN,), generator=generator)
+    suffixes = [torch.randint(1, 128, (n,), generator=generator) for n in SUFFIX_LENS]
+    batch_size, full_len, suffix_len = len(suffixes), PREFIX_LEN + max(SUFFIX_LENS), max(SUFFIX_LENS)
+
+    full = {
+        "input_ids": torch.full((batch_size, full_len), PAD_ID),
+        "attention_mask": torch.zeros((batch_size, full_len), dtype=torch.long),
+        "labels": torch.full((batch_size, full_len), -100),
+    }
+    shared = {
+        "prefix_ids": prefix.unsqueeze(0),
+        "input_ids": torch.full((batch_size, suffix_len), PAD_ID),
+        "attention_mask": torch.zeros((batch_size, suffix_len), dtype=torch.long),
+        "labels": torch.full((batch_size, suffix_len), -100),
+    }
+    for row, (suffix, targets) in enumerate(zip(suffixes, TARGET_LENS)):
+        n = len(suffix)
+        sample = torch.cat([prefix, suffix])
+        full["input_ids"][row, :len(sample)] = sample
+        full["attention_mask"][row, :len(sample)] = 1
+        full["labels"][row, len(sample) - targets:len(sample)] = sample[-targets:]
+        shared["input_ids"][row, :n] = suffix
+        shared["attention_mask"][row, :n] = 1
+        shared["labels"][row, n - targets:n] = suffix[-targets:]
+    return full, shared
+
+
+def loss_and_grads(model, loss_fn):
+    model.zero_grad(set_to_none=True)
+    loss = loss_fn()
+    loss.backward()
+    grads = {name: p.grad.clone() for name, p in model.named_parameters() if p.requires_grad}
+    return loss.item(), grads
+
+
+def compare(name, reference, candidate):
+    (reference_loss, reference_grads), (loss, grads) = reference, candidate
+    grad_error = max(
+        ((reference_grads[key] - grads[key]).norm() / reference_grads[key].norm().clamp_min(1e-12)).item()
+        for key in reference_grads
+    )
+    ok = abs(reference_loss - loss) <= TOLERANCE and grad_error <= TOLERANCE
+    print(f"[{'ok' if ok else '不一致'}] {name}: loss {reference_loss:.6f} vs {loss:.6f}, LoRA 梯度最大相对误差 {grad_error:.2e}")
+    return ok
+
+
+def main():
+    model = build_model()
+    full, shared = build_batches()
+
+    reference = loss_and_grads(model, lambda: model(**full).loss)
+    results = [
+        compare("共享前缀", reference, loss_and_grads(model, lambda: model(**shared_prefix_inputs(model, shared)).loss)),
+        compare("只算目标位置 logits", reference, loss_and_grads(model, lambda: target_logits_loss(model, full)[0])),
+        compare("共享前缀 + 只算目标位置 logits", reference, loss_and_grads(
+            model, lambda: target_logits_loss(model, shared_prefix_inputs(model, shared))[0]
+        )),
+    ]
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import os
+import sys
+import re
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.agent import ToolCallStreamParser, extract_tool_call
+
+# ToolCallStreamParser 逐块喂入时, 输出的调用必须与 extract_tool_call 的结果一致:
+# 调用列表按 "|" 拆开, 澄清问句 (即使含括号) 整段输出。不需要模型。
+DATA_FILE = "data/sample_data.jsonl"
+CASES = [
+    ('<tool>您是想让车载娱乐系统进入休眠模式吗？还是整个车载系统(包括空调)都待机？</tool>',
+     ['您是想让车载娱乐系统进入休眠模式吗？还是整个车载系统(包括空调)都待机？']),
+    ('<tool>请问您要打给谁？</tool>', ['请问您要打给谁？()']),
+    ('<tool>BlueToothOnOff(ActionType=True)|ControlSound(VolumeType="媒体音量", Percentage=30)</tool>',
+     ['BlueToothOnOff(ActionType=True)', 'ControlSound(VolumeType="媒体音量", Percentage=30)']),
+    ('<tool>CreateNote(Title="a|b (c)", Content="x")</tool>', ['CreateNote(Title="a|b (c)", Content="x")']),
+    ('<tool>CheckBatteryLevel</tool>', ['CheckBatteryLevel()']),
+    ('<tool>CheckBatteryLevel() | EmptyBin()</tool>', ['CheckBatteryLevel()', 'EmptyBin()']),
+    ('请问您要打给谁？', ['请问您要打给谁？']),
+]
+
+
+def expected_calls(reply):
+    # 与 run() 的结果对应: 调用列表按 "|" 拆开, 其余 (澄清问句) 整段
+    result = extract_tool_call(reply)
+    if re.match(r"[A-Z]\w*\(", result):
+        return [call.strip() for call in result.split("|") if call.strip()]
+    return [result] if result else []
+
+
+def stream(reply, chunk_size):
+    parser = ToolCallStreamParser()
+    calls = []
+    for start in range(0, len(reply), chunk_size):
+        calls.extend(parser.feed(reply[start:start + chunk_size]))
+    return calls + parser.finish()
+
+
+def load_replies(file_path):
+    if not os.path.exists(file_path):
+        print(f"[跳过] 文件不存在: {file_path}")
+        return []
+    replies = []
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                replies.extend(
+                    f"<tool>{turn['content']}</tool>" for turn in json.loads(line)['data'] if turn['role'] == 'assistant'
+                )
+    return replies
+
+
+def main():
+    cases = CASES + [(reply, expected_calls(reply)) for reply in load_replies(DATA_FILE)]
+    mismatches = 0
+    for reply, expected in cases:
+        for chunk_size in (1, 3, 7, len(reply)):
+            calls = stream(reply, chunk_size)
+            if calls != expected:
+                mismatches += 1
+                print(f"[不一致] 分块 {chunk_size}: {reply}\n  期望 {expected}\n  实际 {calls}")
+                break
+    print(f"回复 {len(cases)} 条, 不一致 {mismatches} 条")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.agent import CustomAgent
+
+# --- 配置 ---
+DATA_FILE = "data/sample_data.jsonl"
+
+
+def load_prefixes(file_path):
+    """每个 assistant 轮之前的对话都作为一个输入，多轮样本也覆盖到带 assistant 历史的模板"""
+    prefixes = []
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            dialogue = json.loads(line)['data']
+            for i, turn in enumerate(dialogue):
+                if turn['role'] == 'assistant' and i > 0 and dialogue[i - 1]['role'] == 'user':
+                    prefixes.append(dialogue[:i])
+    return prefixes
+
+
+def main():
+    agent = CustomAgent(warmup_runs=0)
+    llm = agent.llm
+    prefixes = load_prefixes(DATA_FILE)
+    messages_list = [[{"role": "system", "content": agent.system_prompt}] + history for history in prefixes]
+
+    mismatches = 0
+    for i, messages in enumerate(messages_list, start=1):
+        if not llm.verify_system_segment(messages):
+            mismatches += 1
+            print(f"[MISMATCH] sample {i}")
+
+    # 完整模板 + 完整分词 vs 只处理系统段之后的消息
+    start = time.perf_counter()
+    for messages in messages_list:
+        text = llm.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        llm.tokenizer([text], return_tensors="pt")
+    full_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for messages in messages_list:
+        llm.encode_messages(messages)
+    suffix_time = time.perf_counter() - start
+
+    n = len(messages_list)
+    print(f"检查完成: {n} 条输入, {mismatches} 条 token 序列不一致")
+    print(f"每条编码耗时: {full_time / n * 1000:.2f}ms -> {suffix_time / n * 1000:.2f}ms")
+    if mismatches == 0:
+        print("只编码后缀与完整模板分词结果完全一致 ✅")
+    else:
+        print("只编码后缀与完整模板分词结果存在差异 ❌")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+import json
+
+# 全部训练数据; sample_data 单独列出, 作为评测集
+TRAIN_DATA_FILES = [
+    "data/final_data/单轮单指令_冒烟.jsonl",
+    "data/final_data/单轮单指令_增强.jsonl",
+    "data/final_data/多轮单指令_冒烟.jsonl",
+    "data/final_data/多轮单指令_增强.jsonl",
+    "data/final_data/单轮多指令_增强.jsonl",
+    "data/final_data/单轮多指令_合成.jsonl",
+    "data/final_data/多轮多指令_增强.jsonl",
+    "data/final_data/决赛冒烟集.jsonl",
+    "data/final_data/高质量多轮多.jsonl",
+]
+SAMPLE_DATA_FILE = "data/sample_data.jsonl"
+
+
+def load_prompts(file_path):
+    """把每条样本截到最后一个 user 轮，作为推理输入"""
+    prompts = []
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            history = item['data'][:-1]
+            if history and history[-1]['role'] == 'user':
+                prompts.append(history)
+    return prompts
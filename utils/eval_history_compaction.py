@@ -0,0 +1,69 @@
+import os
+import sys
+import json
+
+from transformers import AutoTokenizer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.agent import SYSTEM_PROMPT, CustomAgent, compact_history
+
+# --- 配置 ---
+# python utils/eval_history_compaction.py            # 只统计节省的 prompt token (只需要 tokenizer)
+# python utils/eval_history_compaction.py accuracy   # 另外加载模型, 比较压缩前后多轮样本的准确率
+DATA_FILE = "data/sample_data.jsonl"
+MODEL_PATH = "models/Qwen3-1.7B"
+MAX_TOKENS_LIST = [128, 256, 512]
+
+
+def load_multi_turn_cases(file_path):
+    """多轮样本中每个 assistant 轮之前的对话 + 参考答案"""
+    cases = []
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            dialogue = json.loads(line)['data']
+            for i, turn in enumerate(dialogue):
+                if turn['role'] == 'assistant' and i > 2 and dialogue[i - 1]['role'] == 'user':
+                    cases.append((dialogue[:i], turn['content'].strip()))
+    return cases
+
+
+def prompt_tokens(tokenizer, history):
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}] + history
+    text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return len(tokenizer(text).input_ids)
+
+
+def main():
+    cases = load_multi_turn_cases(DATA_FILE)
+    print(f"多轮用例 {len(cases)} 个")
+    if not cases:
+        return
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
+
+    full = sum(prompt_tokens(tokenizer, history) for history, _ in cases)
+    full_history = full - len(cases) * prompt_tokens(tokenizer, [])
+    for max_tokens in MAX_TOKENS_LIST:
+        compacted, changed = 0, 0
+        for history, _ in cases:
+            short = compact_history(history, tokenizer, max_tokens)
+            changed += short is not history
+            compacted += prompt_tokens(tokenizer, short)
+        print(
+            f"max_tokens={max_tokens:>4}: 压缩 {changed}/{len(cases)} 个用例, 平均 prompt "
+            f"{full / len(cases):.0f} -> {compacted / len(cases):.0f} tokens, "
+            f"历史部分节省 {(full - compacted) / max(full_history, 1):.1%}"
+        )
+
+    if len(sys.argv) > 1 and sys.argv[1] == "accuracy":
+        agent = CustomAgent()
+        for max_tokens in [None] + MAX_TOKENS_LIST:
+            agent.history_max_tokens = max_tokens
+            correct = sum(agent.run(history) == reference for history, reference in cases)
+            print(f"max_tokens={max_tokens}: 准确率 {correct}/{len(cases)} ({correct / len(cases):.3f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import os
+import re
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.agent import SYSTEM_PROMPT, ToolRetriever
+from utils.common import TRAIN_DATA_FILES, SAMPLE_DATA_FILE
+
+# --- 配置 ---
+DATA_FILES = TRAIN_DATA_FILES + [SAMPLE_DATA_FILE]
+TOP_K_LIST = [5, 10, 15, 20, 30]
+
+
+def load_cases(file_paths, tool_names):
+    """每个带工具调用的 assistant 轮作为一个检索样本: (之前的对话, 标注用到的工具集合)"""
+    cases = []
+    for file_path in file_paths:
+        if not os.path.exists(file_path):
+            print(f"[跳过] 文件不存在: {file_path}")
+            continue
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    dialogue = json.loads(line)['data']
+                except (json.JSONDecodeError, KeyError):
+                    continue
+                for i, turn in enumerate(dialogue):
+                    if turn['role'] != 'assistant':
+                        continue
+                    gold = set(re.findall(r"([A-Z][A-Za-z]*)\(", turn['content'])) & tool_names
+                    if gold:
+                        cases.append((dialogue[:i], gold))
+    return cases
+
+
+def main():
+    retriever = ToolRetriever(SYSTEM_PROMPT)
+    cases = load_cases(DATA_FILES, set(retriever.tool_lines))
+    print(f"共 {len(cases)} 个检索样本, 工具总数 {len(retriever.tool_lines)}, 完整提示词 {len(SYSTEM_PROMPT)} 字符\n")
+
+    print(f"{'top_k':>5} | {'recall':>7} | {'full_hit':>8} | {'fallback':>8} | {'avg_tools':>9} | {'prompt_chars':>12} | {'latency_ms':>10}")
+    for top_k in TOP_K_LIST:
+        hit, total, full_hit, fallback, tools, chars = 0, 0, 0, 0, 0, 0
+        start = time.perf_counter()
+        for history, gold in cases:
+            selected = retriever.select(history, top_k)
+            if selected is None:
+                # 回退到完整工具列表, 召回必然完整
+                fallback += 1
+                selected = set(retriever.tool_lines)
+            hit += len(gold & selected)
+            total += len(gold)
+            full_hit += gold <= selected
+            tools += len(selected)
+            chars += len(retriever.build_prompt(history, top_k))
+        latency = (time.perf_counter() - start) / len(cases) * 1000
+        n = len(cases)
+        print(
+            f"{top_k:>5} | {hit / total:>7.3f} | {full_hit / n:>8.3f} | {fallback / n:>8.3f} | "
+            f"{tools / n:>9.1f} | {chars / n:>12.0f} | {latency:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.agent import BaseLLM, MERGED_MODEL_PATH
+
+# --- 配置 ---
+BASE_MODEL_PATH = "models/Qwen3-1.7B"
+LORA_WEIGHTS_PATH = "./lora_weights/"
+
+
+def main():
+    # 走原来的 基座 + LoRA + merge_and_unload 路径，只做一次，结果写成 safetensors
+    llm = BaseLLM(BASE_MODEL_PATH, LORA_WEIGHTS_PATH, use_prefix_cache=False)
+    llm.export_merged(MERGED_MODEL_PATH)
+
+
+if __name__ == "__main__":
+    main()